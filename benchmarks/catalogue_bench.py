@@ -0,0 +1,29 @@
+""" Time of the portion and meal portion GETs with and without the catalogue cache.
+
+Usage: python -m benchmarks.catalogue_bench [requests]
+"""
+import sys
+
+from benchmarks.common import bench_app, timed
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION
+
+
+def main(requests=500):
+    print("{:<10}{:>16}{:>16}".format("cache", "portion ms", "mealportions ms"))
+    for label, rows in (("on", 10000), ("off", 0)):
+        with bench_app(meals=1000, portions=2000, portions_per_meal=10, CATALOGUE_CACHE_ROWS=rows) as app:
+            client = app.test_client()
+            # uncompressed, so that the cached compressed bodies are not used
+            headers = {"Accept-Encoding": "identity"}
+
+            def get_all(route, count):
+                for i in range(requests):
+                    assert client.get(ROUTE_ENTRYPOINT + route.format(i % count), headers=headers).status_code == 200
+
+            portion, _ = timed(lambda: get_all(ROUTE_PORTION_COLLECTION + "portion-{}/", 2000))
+            mealportions, _ = timed(lambda: get_all(ROUTE_MEAL_COLLECTION + "meal-{}/mealportions/", 1000))
+            print("{:<10}{:>16.1f}{:>16.1f}".format(label, portion * 1000, mealportions * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
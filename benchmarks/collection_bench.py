@@ -0,0 +1,27 @@
+""" Payload size and serialization time of the collections with the schemas embedded
+in every control versus referenced with schemaUrl (SCHEMA_URLS), and of the data only views.
+
+Usage: python -m benchmarks.collection_bench [items]
+"""
+import sys
+
+from benchmarks.common import bench_app, timed
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION, \
+    ROUTE_MEALRECORD_COLLECTION
+
+
+def main(items=2000):
+    print("{:<14}{:<10}{:>14}{:>12}".format("collection", "view", "bytes", "ms"))
+    for schema_urls, views in ((False, ["mason"]), (True, ["mason", "compact", "columns"])):
+        with bench_app(meals=items, portions=items, records=items, SCHEMA_URLS=schema_urls) as app:
+            client = app.test_client()
+            for route in (ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION, ROUTE_MEALRECORD_COLLECTION):
+                for view in views:
+                    url = ROUTE_ENTRYPOINT + route + "?limit={}&view={}".format(items, view)
+                    elapsed, r = timed(lambda: client.get(url))
+                    label = view if view != "mason" else "url" if schema_urls else "embedded"
+                    print("{:<14}{:<10}{:>14}{:>12.1f}".format(route.strip('/'), label, len(r.data), elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
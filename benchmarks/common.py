@@ -0,0 +1,65 @@
+""" Helpers shared by the benchmarks: an app on a temporary database filled with generated rows """
+import os
+import time
+import datetime
+import tempfile
+from contextlib import contextmanager
+
+from tapi import db, create_app
+
+
+@contextmanager
+def bench_app(persons=1, meals=0, portions=0, portions_per_meal=0, records=0, **config):
+    """ Yields an app whose database has the given number of generated rows.
+    Rows are bulk inserted with Core, so the rollup is rebuilt at the end """
+    db_fd, db_fname = tempfile.mkstemp()
+    config.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite:///" + db_fname)
+    config.setdefault("MAX_PAGE_SIZE", 10 ** 7)
+    app = create_app(config)
+    with app.app_context():
+        from tapi.models import Person, Meal, Portion, MealPortion, MealRecord
+        from tapi.rollup import rebuild_rollup
+        # sqlite_sequence of the AUTOINCREMENT keys belongs to SQLite, it can't be dropped
+        db.metadata.reflect(db.engine, only=lambda name, meta: not name.startswith("sqlite_"))
+        db.drop_all()
+        db.create_all()
+        # the integer keys are the row numbers + 1
+        insert(Person, [{'key': i + 1, 'id': 'person-{}'.format(i)} for i in range(persons)])
+        insert(Portion, [{'key': i + 1, 'id': 'portion-{}'.format(i), 'name': 'Portion {}'.format(i), 'calories': 100 + i % 300,
+                          'density': 0.9, 'alcohol': 0, 'carbohydrate': 20, 'protein': 10, 'fat': 5}
+                         for i in range(portions)])
+        insert(Meal, [{'key': i + 1, 'id': 'meal-{}'.format(i), 'name': 'Meal {}'.format(i), 'servings': 2,
+                       'description': 'Generated meal number {}'.format(i)} for i in range(meals)])
+        insert(MealPortion, [{'meal_key': i + 1, 'portion_key': (i + j) % portions + 1,
+                              'weight_per_serving': 50 + j}
+                             for i in range(meals) for j in range(min(portions_per_meal, portions))])
+        start = datetime.datetime(2021, 1, 1)
+        insert(MealRecord, [{'person_key': i % persons + 1, 'meal_key': i % meals + 1,
+                             'amount': 1 + i % 3, 'timestamp': start + datetime.timedelta(minutes=17 * i)}
+                            for i in range(records)] if meals else [])
+        db.session.commit()
+        rebuild_rollup()
+    try:
+        yield app
+    finally:
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+def insert(model, rows, chunk=10000):
+    for i in range(0, len(rows), chunk):
+        db.session.execute(model.__table__.insert(), rows[i:i + chunk])
+
+
+def timed(func, repeat=3):
+    """ Best wall time of func in seconds and its last result """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
@@ -0,0 +1,32 @@
+""" Size and time of the meal and portion collections with every Content-Encoding, for the
+first request that compresses the response and for the next ones served from the cache.
+
+Usage: python -m benchmarks.compression_bench [items]
+"""
+import sys
+import time
+
+from benchmarks.common import bench_app, timed
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION
+
+
+def main(items=2000):
+    with bench_app(meals=items, portions=items) as app:
+        from tapi.compression import COMPRESSORS
+        client = app.test_client()
+        print("{:<12}{:<10}{:>12}{:>12}{:>12}".format("collection", "encoding", "bytes", "first ms", "cached ms"))
+        for route in (ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION):
+            url = ROUTE_ENTRYPOINT + route + "?limit={}".format(items)
+            for encoding in ["identity"] + list(COMPRESSORS):
+                headers = {"Accept-Encoding": encoding}
+                app.extensions.pop('tapi_compressed_cache', None)
+                start = time.perf_counter()
+                r = client.get(url, headers=headers)
+                first = time.perf_counter() - start
+                cached, _ = timed(lambda: client.get(url, headers=headers).data)
+                print("{:<12}{:<10}{:>12}{:>12.1f}{:>12.1f}".format(
+                    route.strip('/'), encoding, len(r.data), first * 1000, cached * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
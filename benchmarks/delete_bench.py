@@ -0,0 +1,26 @@
+""" Time of DELETE on a meal and on a person that have many meal records.
+
+Usage: python -m benchmarks.delete_bench [records]
+"""
+import sys
+import time
+
+from benchmarks.common import bench_app
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEAL_COLLECTION, ROUTE_PERSON_COLLECTION
+
+
+def main(records=100000):
+    print("{:<10}{:>10}{:>12}".format("delete", "records", "ms"))
+    for label, route in (("meal", ROUTE_MEAL_COLLECTION + "meal-0/"), ("person", ROUTE_PERSON_COLLECTION + "person-0/")):
+        # one meal and one person own all the records
+        with bench_app(persons=1, meals=1, portions=5, portions_per_meal=3, records=records) as app:
+            client = app.test_client()
+            start = time.perf_counter()
+            r = client.delete(ROUTE_ENTRYPOINT + route)
+            elapsed = time.perf_counter() - start
+            assert r.status_code == 204
+            print("{:<10}{:>10}{:>12.1f}".format(label, records, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,36 @@
+""" Payload size and encode/decode time of the meal record collection in JSON and
+in the binary encodings (BINARY_CODECS), as Mason and as the columns view.
+
+Usage: python -m benchmarks.encoding_bench [items]
+"""
+import sys
+import json
+
+from benchmarks.common import bench_app, timed
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEALRECORD_COLLECTION
+
+
+def main(items=10000):
+    with bench_app(meals=10, records=items, SCHEMA_URLS=True) as app:
+        from tapi.utils import BINARY_CODECS, JSON_ENCODERS
+        codecs = {'json': (JSON_ENCODERS['json'], json.loads)}
+        if 'orjson' in JSON_ENCODERS:
+            import orjson
+            codecs['orjson'] = (JSON_ENCODERS['orjson'], orjson.loads)
+        codecs.update(BINARY_CODECS)
+
+        client = app.test_client()
+        print("{:<10}{:<22}{:>12}{:>12}{:>12}".format("view", "encoding", "bytes", "encode ms", "decode ms"))
+        for view in ("mason", "columns"):
+            url = ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?limit={}&view={}".format(items, view)
+            doc = json.loads(client.get(url).data)
+            with app.test_request_context():
+                for name, (encode, decode) in codecs.items():
+                    encode_time, data = timed(lambda: encode(doc))
+                    decode_time, _ = timed(lambda: decode(data))
+                    print("{:<10}{:<22}{:>12}{:>12.1f}{:>12.1f}".format(
+                        view, name, len(data), encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,40 @@
+""" Time to encode the meal, portion and meal record collections with every JSON encoder
+(JSON_ENCODER), on its own and as part of the whole GET.
+
+Usage: python -m benchmarks.json_bench [items]
+"""
+import sys
+
+from benchmarks.common import bench_app, timed
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION, \
+    ROUTE_MEALRECORD_COLLECTION
+
+
+def main(items=10000):
+    with bench_app(meals=items, portions=items, records=items) as app:
+        from tapi.models import Meal, Portion, MealRecord
+        from tapi.resources.meal import meal_collection_item, meal_item_controls
+        from tapi.resources.portion import portion_collection_item, portion_item_controls
+        from tapi.resources.mealrecord import mealrecord_collection_item, mealrecord_item_controls
+        from tapi.utils import JSON_ENCODERS
+        collections = [
+            (ROUTE_MEAL_COLLECTION, Meal, meal_collection_item, meal_item_controls),
+            (ROUTE_PORTION_COLLECTION, Portion, portion_collection_item, portion_item_controls),
+            (ROUTE_MEALRECORD_COLLECTION, MealRecord, mealrecord_collection_item, mealrecord_item_controls)
+        ]
+        client = app.test_client()
+        print("{:<14}{:<10}{:>12}{:>12}".format("collection", "encoder", "encode ms", "GET ms"))
+        for route, model, build_item, item_controls in collections:
+            with app.test_request_context():
+                controls = item_controls()
+                doc = {'items': [build_item(row, controls) for row in model.query.all()]}
+            for name, encode in JSON_ENCODERS.items():
+                app.config["JSON_ENCODER"] = name
+                encode_time, _ = timed(lambda: encode(doc))
+                get_time, _ = timed(lambda: client.get(ROUTE_ENTRYPOINT + route + "?limit={}".format(items)).data)
+                print("{:<14}{:<10}{:>12.1f}{:>12.1f}".format(
+                    route.strip('/'), name, encode_time * 1000, get_time * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,66 @@
+""" Mixed read/write throughput with the default and the production SQLite profile.
+
+Reader threads GET pages of the meal record collection while writer threads POST
+new meal records, for a fixed time.
+
+Usage: python -m benchmarks.sqlite_bench [seconds] [readers] [writers]
+"""
+import sys
+import json
+import time
+import datetime
+import threading
+import itertools
+
+from benchmarks.common import bench_app
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEALRECORD_COLLECTION
+
+APPLICATION_JSON = "application/json"
+
+
+def run(app, seconds, readers, writers):
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    timestamps = itertools.count()
+    deadline = time.perf_counter() + seconds
+
+    def count(name):
+        with lock:
+            counts[name] += 1
+
+    def reader():
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?limit=50")
+            count('reads' if r.status_code == 200 else 'errors')
+
+    def writer():
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            timestamp = datetime.datetime(2022, 1, 1) + datetime.timedelta(seconds=next(timestamps))
+            r = client.post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION, content_type=APPLICATION_JSON,
+                            data=json.dumps({'person_id': 'person-0', 'meal_id': 'meal-0', 'amount': 1,
+                                             'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')}))
+            count('writes' if r.status_code == 201 else 'errors')
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)] + \
+              [threading.Thread(target=writer) for _ in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return counts
+
+
+def main(seconds=5, readers=4, writers=2):
+    print("{:<12}{:>10}{:>10}{:>10}".format("profile", "reads/s", "writes/s", "errors"))
+    for profile in ("default", "production"):
+        with bench_app(persons=10, meals=10, portions=10, portions_per_meal=3, records=20000,
+                       SQLITE_PROFILE=profile) as app:
+            counts = run(app, seconds, readers, writers)
+            print("{:<12}{:>10.0f}{:>10.0f}{:>10}".format(
+                profile, counts['reads'] / seconds, counts['writes'] / seconds, counts['errors']))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
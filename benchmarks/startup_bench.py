@@ -0,0 +1,48 @@
+""" Cold start time of the app: import time of tapi and create_app with and without FAST_START.
+
+Every measurement runs in a new interpreter against a bootstrapped database file.
+
+Usage: python -m benchmarks.startup_bench [runs]
+"""
+import os
+import sys
+import tempfile
+import subprocess
+
+CHILD = """
+import time
+start = time.perf_counter()
+import tapi
+imported = time.perf_counter()
+app = tapi.create_app({{"SQLALCHEMY_DATABASE_URI": "sqlite:///{db}", "FAST_START": {fast}}})
+created = time.perf_counter()
+print(imported - start, created - imported)
+"""
+
+
+def measure(db_fname, fast):
+    out = subprocess.check_output([sys.executable, "-c", CHILD.format(db=db_fname, fast=fast)])
+    import_time, create_time = (float(v) for v in out.split())
+    return import_time, create_time
+
+
+def main(runs=5):
+    db_fd, db_fname = tempfile.mkstemp()
+    try:
+        # first start bootstraps the DB, the measured ones find it ready
+        measure(db_fname, False)
+        print("{:<12}{:>14}{:>18}{:>12}".format("mode", "import ms", "create_app ms", "total ms"))
+        for fast in (False, True):
+            results = [measure(db_fname, fast) for _ in range(runs)]
+            import_time = min(r[0] for r in results)
+            create_time = min(r[1] for r in results)
+            print("{:<12}{:>14.0f}{:>18.0f}{:>12.0f}".format(
+                "fast start" if fast else "bootstrap", import_time * 1000, create_time * 1000,
+                (import_time + create_time) * 1000))
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,23 @@
+""" Size of the database file per meal record, with the records, their indexes and the rollup.
+
+Usage: python -m benchmarks.storage_bench [records]
+"""
+import os
+import sys
+
+from benchmarks.common import bench_app
+from tapi import db
+
+
+def main(records=100000):
+    print("{:>10}{:>12}{:>16}".format("records", "MB", "bytes/record"))
+    with bench_app(persons=50, meals=200, portions=100, portions_per_meal=4, records=records) as app:
+        with app.app_context():
+            with db.engine.connect() as connection:
+                connection.execute("VACUUM")
+            size = os.path.getsize(db.engine.url.database)
+    print("{:>10}{:>12.1f}{:>16.0f}".format(records, size / 10 ** 6, size / records))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
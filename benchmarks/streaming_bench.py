@@ -0,0 +1,43 @@
+""" Peak memory and time to first byte of a big meal record collection page,
+buffered versus streamed (STREAM_COLLECTIONS).
+
+Usage: python -m benchmarks.streaming_bench [records]
+"""
+import sys
+import time
+import tracemalloc
+
+from benchmarks.common import bench_app
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEALRECORD_COLLECTION
+
+
+def measure(client, url):
+    tracemalloc.start()
+    start = time.perf_counter()
+    r = client.get(url, buffered=False)
+    chunks = iter(r.response)
+    size = len(next(chunks))
+    first_byte = time.perf_counter() - start
+    for chunk in chunks:
+        size += len(chunk)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    r.close()
+    return size, first_byte, total, peak
+
+
+def main(records=100000):
+    print("{:<10}{:>12}{:>10}{:>10}{:>12}".format("mode", "bytes", "ttfb ms", "total ms", "peak MiB"))
+    with bench_app(persons=10, meals=100, records=records) as app:
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?limit={}".format(records)
+        for stream in (False, True):
+            app.config["STREAM_COLLECTIONS"] = stream
+            size, first_byte, total, peak = measure(client, url)
+            print("{:<10}{:>12}{:>10.0f}{:>10.0f}{:>12.1f}".format(
+                "streamed" if stream else "buffered", size, first_byte * 1000, total * 1000, peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
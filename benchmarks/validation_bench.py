@@ -0,0 +1,54 @@
+""" Micro-benchmark of the request body validation cost per request.
+
+Compares the old way (schema factory + jsonschema.validate on every request) with the
+validators of the registry, compiled once at import.
+
+Usage: python -m benchmarks.validation_bench
+"""
+import timeit
+
+from jsonschema import validate
+
+from tapi import create_app
+from tapi.validators import VALIDATORS, fastjsonschema
+
+ROUNDS = 2000
+
+BODIES = {
+    "meal": {'id': 'salmon-soup', 'name': 'Salmon Soup', 'servings': 2,
+             'description': 'Soup with salmon and cream'},
+    "portion": {'id': 'olive-oil', 'name': 'Olive oil', 'calories': 700, 'density': 0.89, 'fat': 100},
+    "mealrecord": {'person_id': '123', 'meal_id': 'salmon-soup', 'amount': 1.5,
+                   'timestamp': '2021-04-21 10:00:00.000000'},
+}
+
+
+def per_request_us(func):
+    return min(timeit.repeat(func, number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+
+
+def main():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    # the resource modules can be imported only after the api has been set up
+    from tapi.resources.meal import meal_schema
+    from tapi.resources.mealrecord import mealrecord_schema
+    from tapi.resources.portion import portion_schema
+    factories = {"meal": meal_schema, "portion": portion_schema, "mealrecord": mealrecord_schema}
+
+    print("{:<12}{:>16}{:>16}{:>16}".format("schema", "validate() us", "registry us", "fast us"))
+    for name, body in BODIES.items():
+        factory = factories[name]
+        before = per_request_us(lambda: validate(body, schema=factory()))
+        with app.app_context():
+            validator = VALIDATORS[name]
+            app.config["FAST_VALIDATION"] = False
+            after = per_request_us(lambda: validator.validate(body))
+            fast = "n/a"
+            if fastjsonschema is not None:
+                app.config["FAST_VALIDATION"] = True
+                fast = "{:.1f}".format(per_request_us(lambda: validator.validate(body)))
+        print("{:<12}{:>16.1f}{:>16.1f}{:>16}".format(name, before, after, fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,59 @@
 # BEGIN of the content taken from the exercise example
 import os
+import click
 from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
 # END of the content taken from the exercise example
+from tapi.constants import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MAX_BULK_ITEMS, SQLITE_POOL_SIZE, \
+    METRICS_FLUSH_INTERVAL, ROUTE_METRICS, COMPRESS_MIN_SIZE, COMPRESS_LEVELS, COMPRESS_CACHE_BYTES, \
+    CATALOGUE_CACHE_ROWS
 db = SQLAlchemy()
 
 
+def bootstrap_db(example_data=True):
+    """ Upgrades the layout of an old DB, creates the missing tables and indexes and loads the
+    example data into an empty DB """
+    from tapi.models import create_missing_indexes, upgrade_to_integer_keys, upgrade_autoincrement_keys, \
+        upgrade_epoch_timestamps
+    upgraded = upgrade_to_integer_keys(db.engine)
+    upgrade_autoincrement_keys(db.engine)
+    upgrade_epoch_timestamps(db.engine)
+    db.create_all()
+    create_missing_indexes(db.engine)
+    if upgraded:
+        from tapi.rollup import rebuild_rollup
+        rebuild_rollup()
+    if example_data:
+        from tapi.example_data import db_load_example_data
+        db_load_example_data(db)
+
+
 # create_app with test_config adopted from the course example
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
+    # request bodies can also be in the binary encodings of tapi.utils.BINARY_CODECS
+    from tapi.utils import CalorieRequest
+    app.request_class = CalorieRequest
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///test.db"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["PAGE_SIZE"] = DEFAULT_PAGE_SIZE
+    app.config["MAX_PAGE_SIZE"] = MAX_PAGE_SIZE
+    app.config["SCHEMA_URLS"] = False
+    app.config["STREAM_COLLECTIONS"] = False
+    app.config["JSON_ENCODER"] = "auto"
+    app.config["COMPRESSION"] = True
+    app.config["COMPRESS_MIN_SIZE"] = COMPRESS_MIN_SIZE
+    app.config["COMPRESS_LEVELS"] = dict(COMPRESS_LEVELS)
+    app.config["COMPRESS_CACHE_BYTES"] = COMPRESS_CACHE_BYTES
+    app.config["CATALOGUE_CACHE_ROWS"] = CATALOGUE_CACHE_ROWS
+    app.config["MAX_BULK_ITEMS"] = MAX_BULK_ITEMS
+    app.config["SQLITE_PROFILE"] = "default"
+    app.config["SQLITE_PRAGMAS"] = {}
+    app.config["SQLITE_POOL_SIZE"] = SQLITE_POOL_SIZE
+    app.config["FAST_START"] = False
+    app.config["INSTRUMENTATION"] = False
+    app.config["METRICS_DIR"] = None
+    app.config["METRICS_FLUSH_INTERVAL"] = METRICS_FLUSH_INTERVAL
     if test_config is None:
         app.config.from_pyfile("config.py", silent=True)
     else:
@@ -22,15 +65,34 @@ def create_app(test_config=None):
         pass
 
     db.init_app(app)
+    from tapi.dbprofile import init_sqlite_profile
+    init_sqlite_profile(app)
 
     from tapi import api
     app.register_blueprint(api.api_blueprint)
 
-    # Create all the tables if don't exist
-    with app.app_context():
-        db.create_all()
-        from tapi.example_data import db_load_example_data
-        db_load_example_data(db)
+    from tapi.instrumentation import init_pool_timing, prometheus_metrics
+    init_pool_timing(app)
+    app.add_url_rule(ROUTE_METRICS, "metrics", prometheus_metrics)
+
+    # Keeps the NutritionRollup current on every flush
+    from tapi import rollup
+
+    @app.cli.command("rebuild-rollup")
+    def rebuild_rollup_command():
+        """ Repairs the daily nutrition rollup from the meal records """
+        rollup.rebuild_rollup()
+
+    @app.cli.command("init-db")
+    @click.option("--example-data/--no-example-data", default=True, help="Load the example data into an empty DB")
+    def init_db_command(example_data):
+        """ Creates the missing tables and indexes """
+        bootstrap_db(example_data)
+
+    # Create all the tables if don't exist, with FAST_START this is left to 'flask init-db'
+    if not app.config["FAST_START"]:
+        with app.app_context():
+            bootstrap_db()
 
 
 
@@ -3,8 +3,7 @@
 # https://flask-restful.readthedocs.io/en/latest/intermediate-usage.html#use-with-blueprints
 
 # This is used in the __init__ when creating the Flask instance
-import json
-from flask import Blueprint, Response, redirect
+from flask import Blueprint, Response, redirect, request
 from flask_restful import Api
 from tapi.constants import *
 
@@ -16,14 +15,23 @@ from tapi.resources.meal import MealItem
 from tapi.resources.mealrecord import MealRecordItem
 from tapi.resources.mealportion import MealPortionItem
 from tapi.resources.portion import PortionItem
-from tapi.utils import CalorieBuilder, add_mason_response_header, add_calorie_namespace
+from tapi.resources.nutrition import NutritionItem
+from tapi.utils import CalorieBuilder, add_calorie_namespace, error_404, encode_json, mason_response
+from tapi.validators import VALIDATORS
+# Hooks of the INSTRUMENTATION config option
+from tapi.instrumentation import resource_label
+from tapi.compression import compress_response
 
 
+# Registered after the instrumentation hooks, so it runs before them and they see the compressed size
+api_blueprint.after_request(compress_response)
+
 api.add_resource(PersonItem, ROUTE_PERSON, ROUTE_PERSON_COLLECTION)
 api.add_resource(MealItem, ROUTE_MEAL, ROUTE_MEAL_COLLECTION)
 api.add_resource(MealRecordItem, ROUTE_MEALRECORD, ROUTE_MEALRECORD_COLLECTION)
 api.add_resource(MealPortionItem, ROUTE_MEALPORTION)
 api.add_resource(PortionItem, ROUTE_PORTION, ROUTE_PORTION_COLLECTION)
+api.add_resource(NutritionItem, ROUTE_NUTRITION)
 
 
 # Route for entry point
@@ -34,19 +42,41 @@ def entrypoint():
     resp.add_control(NS + ':meals-all', api.url_for(MealItem, handle=None))
     resp.add_control(NS + ':portions-all', api.url_for(PortionItem, handle=None))
     add_calorie_namespace(resp)
-    return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+    return mason_response(resp)
+
+
+# Route for the request body schemas, referenced by the controls with schemaUrl
+@api_blueprint.route(ROUTE_SCHEMA)
+def schema(name):
+    validator = VALIDATORS.get(name)
+    if validator is None:
+        return error_404()
+    resp = Response(encode_json(validator.schema), 200, mimetype=JSON_SCHEMA)
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 
 # Route for MealRecords for person
 @api_blueprint.route('/persons/<handle>/mealrecords/')
+@resource_label(MealRecordItem)
 def meals_for_person(handle):
     return MealRecordItem.get_records_for_person(handle)
 
 
-# Route for MealPortion POST
-@api_blueprint.route('/meals/<handle>/mealportions/', methods=['POST'])
+# Route for MealRecord bulk POST
+@api_blueprint.route(ROUTE_MEALRECORD_BULK, methods=['POST'])
+@resource_label(MealRecordItem)
+def mealrecords_bulk():
+    return MealRecordItem.post_bulk()
+
+
+# Route for MealPortions of a meal, GET and POST
+@api_blueprint.route('/meals/<handle>/mealportions/', methods=['GET', 'POST'])
+@resource_label(MealPortionItem)
 def mealportions_for_meal(handle):
-    return MealPortionItem.post(handle)
+    if request.method == 'POST':
+        return MealPortionItem.post(handle)
+    return MealPortionItem.get_portions_for_meal(handle)
 
 
 APIARY_URL = "https://pwp2021calorie.docs.apiary.io/#reference/"
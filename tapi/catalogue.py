@@ -0,0 +1,120 @@
+""" In-process read-through cache of the Portion and Meal catalogues.
+
+A catalogue is all the rows of a table that changes rarely. The rows are read once into an
+immutable snapshot that is tagged with the TableVersion of the table, and served from memory
+until the version changes. Every write bumps the version in the DB, so with several worker
+processes each worker loads a new snapshot on its next read after a write in any of them.
+Readers never lock: a new snapshot replaces the old one with a single assignment. The snapshots
+of all the catalogues are at most CATALOGUE_CACHE_ROWS rows, the least recently used catalogue
+is evicted first and a table bigger than that is read from the DB every time.
+"""
+import itertools
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from flask import current_app
+from sqlalchemy import select
+
+from tapi import db
+from tapi.versions import table_versions
+
+
+class CatalogueSnapshot:
+    """ The rows of a table at one version, as namedtuples by id and by integer key """
+    def __init__(self, version, rows):
+        self.version = version
+        self.by_id = MappingProxyType({row.id: row for row in rows})
+        self.by_key = MappingProxyType({row.key: row for row in rows})
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class CatalogueCache:
+    """ Snapshots of the catalogue tables by table name, at most max_rows rows in all """
+    def __init__(self, max_rows):
+        self.lock = threading.Lock()
+        self.max_rows = max_rows
+        # replaced, never modified, so that the readers can use it without the lock
+        self.snapshots = {}
+        # last use of every table name, ticks of the counter
+        self.used = {}
+        self.ticks = itertools.count()
+        self.row_types = {}
+        # versions of the tables that were too big to cache
+        self.oversized = {}
+
+    def get(self, model):
+        """ The current snapshot of the model's table, None if the table is too big to cache """
+        name = model.__tablename__
+        # the version is read before the rows, so a snapshot is never older than its version
+        version = table_versions([name])[name]
+        if self.oversized.get(name) == version:
+            return None
+        snapshot = self.snapshots.get(name)
+        if snapshot is None or snapshot.version != version:
+            snapshot = self.load(model, version)
+        self.used[name] = next(self.ticks)
+        return snapshot
+
+    def load(self, model, version):
+        table = model.__table__
+        row_type = self.row_types.get(table.name)
+        if row_type is None:
+            row_type = self.row_types[table.name] = namedtuple(model.__name__ + 'Row', table.columns.keys())
+        rows = db.session.execute(select(table.columns).limit(self.max_rows + 1)).fetchall()
+        if len(rows) > self.max_rows:
+            self.oversized[table.name] = version
+            return None
+        snapshot = CatalogueSnapshot(version, [row_type(*row) for row in rows])
+        with self.lock:
+            snapshots = dict(self.snapshots)
+            snapshots[table.name] = snapshot
+            size = sum(len(s) for s in snapshots.values())
+            for name in sorted(snapshots, key=lambda n: self.used.get(n, -1)):
+                if size <= self.max_rows:
+                    break
+                if name != table.name:
+                    size -= len(snapshots.pop(name))
+            self.snapshots = snapshots
+        return snapshot
+
+    def invalidate(self, model):
+        """ Drops the snapshot of the model's table, for the writes of this process """
+        with self.lock:
+            snapshots = dict(self.snapshots)
+            snapshots.pop(model.__tablename__, None)
+            self.snapshots = snapshots
+
+
+def catalogue_cache(app=None):
+    """ Returns the CatalogueCache of the app, the current app by default """
+    if app is None:
+        app = current_app
+    cache = app.extensions.get('tapi_catalogue_cache')
+    if cache is None:
+        cache = app.extensions['tapi_catalogue_cache'] = CatalogueCache(app.config["CATALOGUE_CACHE_ROWS"])
+    return cache
+
+
+def catalogue(model):
+    """ The current CatalogueSnapshot of the model, None if the catalogue is not cached """
+    if not current_app.config["CATALOGUE_CACHE_ROWS"]:
+        return None
+    return catalogue_cache().get(model)
+
+
+def catalogue_row(model, handle):
+    """ The row of the model with the given id, from the catalogue if it is cached and from the
+    DB otherwise. None if there is no such row. """
+    snapshot = catalogue(model)
+    if snapshot is None:
+        return model.query.filter(model.id == handle).first()
+    return snapshot.by_id.get(handle)
+
+
+def invalidate_catalogue(model):
+    """ Called after the writes to the model, the other processes see the new version """
+    if current_app.config["CATALOGUE_CACHE_ROWS"]:
+        catalogue_cache().invalidate(model)
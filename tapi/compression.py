@@ -0,0 +1,184 @@
+""" Content-Encoding of the API responses.
+
+The encoding is negotiated with Accept-Encoding among gzip and, if the packages are installed,
+br (brotli) and zstd (zstandard). Responses smaller than COMPRESS_MIN_SIZE go out as they are.
+The compressed bodies of the responses that have an ETag, i.e. are derived from table versions,
+are kept in an LRU cache by ETag and encoding: until the tables change, the same response is
+compressed once and the cached body is served without building the representation again.
+"""
+import zlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+# Compressors by Content-Encoding, in the order of preference when the client accepts many
+COMPRESSORS = OrderedDict()
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ZstdCompressor
+COMPRESSORS['gzip'] = GzipCompressor
+
+
+class CompressedCache:
+    """ LRU cache of compressed bodies by (ETag, encoding), at most max_bytes of bodies """
+    def __init__(self, max_bytes):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, content_type):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (body, content_type)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+def compressed_cache(app=None):
+    """ Returns the CompressedCache of the app, the current app by default """
+    if app is None:
+        app = current_app
+    cache = app.extensions.get('tapi_compressed_cache')
+    if cache is None:
+        cache = app.extensions['tapi_compressed_cache'] = CompressedCache(app.config["COMPRESS_CACHE_BYTES"])
+    return cache
+
+
+def negotiate_encoding():
+    """ The Content-Encoding for the response, None if it's not compressed """
+    if not current_app.config["COMPRESSION"]:
+        return None
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+
+def new_compressor(encoding):
+    return COMPRESSORS[encoding](current_app.config["COMPRESS_LEVELS"][encoding])
+
+
+def set_encoding_headers(resp, encoding, etag):
+    resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept-Encoding')
+    if etag is not None:
+        # the compressed bytes differ from the uncompressed ones that the strong ETag stands for
+        resp.set_etag(etag, weak=True)
+
+
+def cached_response(etag):
+    """ The response of the cached compressed body of the ETag, None if there is none.
+    For the handlers of conditional_get, before the representation is built. """
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return None
+    entry = compressed_cache().get((etag, encoding))
+    if entry is None:
+        return None
+    body, content_type = entry
+    resp = Response(body, 200, content_type=content_type)
+    resp.vary.add('Accept')
+    set_encoding_headers(resp, encoding, etag)
+    return resp
+
+
+def compress_response(resp):
+    """ after_request hook of the API blueprint that compresses the 200 responses """
+    if resp.status_code != 200 or request.method == 'HEAD' or 'Content-Encoding' in resp.headers:
+        return resp
+    if current_app.config["COMPRESSION"]:
+        resp.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return resp
+    etag, weak = resp.get_etag()
+    cache = compressed_cache()
+    compressor = new_compressor(encoding)
+    content_type = resp.headers.get('Content-Type')
+
+    if not resp.is_streamed:
+        data = resp.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return resp
+        body = compressor.compress(data) + compressor.flush()
+        if etag is not None:
+            cache.put((etag, encoding), body, content_type)
+        resp.set_data(body)
+        set_encoding_headers(resp, encoding, etag)
+        return resp
+
+    # a streamed body is compressed chunk by chunk, it's cached once it's complete
+    def compress_stream(chunks):
+        parts = [] if etag is not None else None
+        for chunk in chunks:
+            part = compressor.compress(chunk)
+            if part:
+                yield part
+                if parts is not None:
+                    parts.append(part)
+        part = compressor.flush()
+        yield part
+        if parts is not None:
+            parts.append(part)
+            cache.put((etag, encoding), b''.join(parts), content_type)
+
+    resp.response = compress_stream(resp.iter_encoded())
+    set_encoding_headers(resp, encoding, etag)
+    return resp
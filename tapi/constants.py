@@ -7,10 +7,87 @@ ROUTE_PORTION_COLLECTION = '/portions/'
 ROUTE_PORTION = '/portions/<handle>/'
 ROUTE_MEALRECORD_COLLECTION = '/mealrecords/'
 ROUTE_MEALRECORD = '/meals/<meal>/mealrecords/<handle>/'
+ROUTE_MEALRECORD_BULK = '/mealrecords/bulk/'
 ROUTE_MEALPORTION = '/meals/<meal>/mealportions/<handle>/'
+ROUTE_NUTRITION = '/persons/<handle>/nutrition/'
+ROUTE_SCHEMA_COLLECTION = '/schemas/'
+ROUTE_SCHEMA = '/schemas/<name>/'
+# Outside of the API, at the usual path of the Prometheus scrapers
+ROUTE_METRICS = '/metrics'
 
 MASON = 'application/vnd.mason+json'
+JSON_SCHEMA = 'application/schema+json'
+NDJSON = 'application/x-ndjson'
+PROMETHEUS_TEXT = 'text/plain; version=0.0.4'
+MSGPACK = 'application/msgpack'
 NS = 'cameta'
+# Data only representations of the collections, without the hypermedia
+COMPACT_JSON = 'application/vnd.cameta.compact+json'
+COLUMNS_JSON = 'application/vnd.cameta.columns+json'
+# Representations of the collections by the name used in the 'view' query parameter
+COLLECTION_VIEWS = {
+    'mason': MASON,
+    'compact': COMPACT_JSON,
+    'columns': COLUMNS_JSON
+}
+# Format of the timestamps in the API documents and the mealrecord handles
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Nutrients of a Portion (per 100g) that are summed up for the nutrition reports
+NUTRIENTS = ['calories', 'protein', 'carbohydrate', 'fat', 'alcohol']
+# Time bucket formats of the nutrition reports
+NUTRITION_BUCKETS = {
+    'day': '%Y-%m-%d',
+    'week': '%Y-W%W',
+    'month': '%Y-%m',
+    'year': '%Y'
+}
+
+# SQLite pragmas applied to every DB connection, chosen with SQLITE_PROFILE in the app config
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        # readers don't block behind a writer and commits don't wait for fsync
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        # negative cache size is in KiB
+        'cache_size': -64 * 1024,
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY'
+    }
+}
+# Connections pooled per process when a profile has pragmas, they are per connection
+SQLITE_POOL_SIZE = 5
+
+# Keyset pagination of the collections, both can be overridden in the app config
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Rows fetched from the DB at a time when iterating over a collection page
+STREAM_BATCH_SIZE = 1000
+# Maximum number of items in one bulk request, can be overridden in the app config
+MAX_BULK_ITEMS = 10000
+# Upper bounds of the histogram buckets of the request instrumentation, see INSTRUMENTATION
+INSTRUMENTATION_BUCKETS = {
+    # seconds
+    'wall_time': [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'pool_wait': [0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5],
+    'sql_time': [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+    'sql_count': [0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000],
+    'response_bytes': [100, 1000, 10000, 100000, 1000000, 10000000]
+}
+# Response compression, each can be overridden in the app config
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVELS = {
+    'gzip': 6,
+    'br': 4,
+    'zstd': 3
+}
+# Size of the compressed bodies kept in the cache of every worker process
+COMPRESS_CACHE_BYTES = 64 * 1024 * 1024
+# Rows of the Portion and Meal catalogues kept in the cache of every worker process
+CATALOGUE_CACHE_ROWS = 10000
+# Seconds between the writes of the metrics of a worker process into METRICS_DIR
+METRICS_FLUSH_INTERVAL = 1.0
 # TODO
 URL_LINK_RELATIONS = 'http://127.0.0.1'
 # TODO
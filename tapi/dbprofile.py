@@ -0,0 +1,40 @@
+""" SQLite connection profile of the app.
+
+The pragmas of SQLITE_PROFILE (overridden with SQLITE_PRAGMAS) are applied on every new
+connection of the engine. Cache and mmap sizes are per connection, so with a profile the
+connections of a file database are pooled instead of opened for every request.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from tapi import db
+from tapi.constants import SQLITE_PROFILES
+
+
+def profile_pragmas(app):
+    pragmas = dict(SQLITE_PROFILES[app.config["SQLITE_PROFILE"]])
+    pragmas.update(app.config["SQLITE_PRAGMAS"])
+    return pragmas
+
+
+def init_sqlite_profile(app):
+    """ Sets up the connection profile, must be called before the engine is used """
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    pragmas = profile_pragmas(app)
+    if url.drivername != 'sqlite' or not pragmas:
+        return
+
+    if url.database not in (None, '', ':memory:'):
+        options = dict(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        options.setdefault('poolclass', QueuePool)
+        options.setdefault('pool_size', app.config["SQLITE_POOL_SIZE"])
+        options['connect_args'] = dict(options.get('connect_args', {}), check_same_thread=False)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    @event.listens_for(db.get_engine(app), "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
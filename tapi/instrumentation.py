@@ -0,0 +1,364 @@
+""" Opt-in request instrumentation of the API blueprint.
+
+With INSTRUMENTATION in the app config every API request records its wall time, the time it
+waited for DB connections from the pool, the number and the total time of the SQL statements
+it executed and the size of the response. The numbers of the request are sent in the
+Server-Timing header and aggregated per route into in-process histograms, see route_metrics().
+The aggregates are served in the Prometheus text format from /metrics, labelled by the
+resource of the route.
+
+The aggregates are per process. With METRICS_DIR every worker process also writes its own
+aggregates into a file of that directory, at most every METRICS_FLUSH_INTERVAL seconds, and
+/metrics sums up the files of all the workers, so it doesn't matter which worker answers.
+"""
+import os
+import copy
+import json
+import time
+import atexit
+import threading
+from bisect import bisect_left
+
+from flask import current_app, g, has_app_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from tapi import db
+from tapi.constants import INSTRUMENTATION_BUCKETS, PROMETHEUS_TEXT
+from tapi.utils import error_404
+from tapi.api import api_blueprint
+
+# Prometheus names and help texts of the INSTRUMENTATION_BUCKETS histograms
+PROMETHEUS_HISTOGRAMS = {
+    'wall_time': ('tapi_request_duration_seconds', 'Time to handle a request'),
+    'pool_wait': ('tapi_db_pool_wait_seconds', 'Time a request waited for DB connections from the pool'),
+    'sql_time': ('tapi_sql_duration_seconds', 'Time of the SQL statements of a request'),
+    'sql_count': ('tapi_sql_statements', 'Number of SQL statements of a request'),
+    'response_bytes': ('tapi_response_size_bytes', 'Size of the response body')
+}
+
+
+class Histogram:
+    """ Fixed bucket histogram: counts[i] is the number of observations not greater than
+    bounds[i] but greater than the previous bound, the last count is for the rest """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count
+        }
+
+
+class RouteStats:
+    """ Aggregates of the requests of one route """
+    def __init__(self, resource, method):
+        self.resource = resource
+        self.method = method
+        self.histograms = {name: Histogram(bounds) for name, bounds in INSTRUMENTATION_BUCKETS.items()}
+        self.statuses = {}
+        self.in_flight = 0
+
+    def to_dict(self):
+        return {
+            'resource': self.resource,
+            'method': self.method,
+            'in_flight': self.in_flight,
+            'statuses': {str(status): n for status, n in self.statuses.items()},
+            'histograms': {name: h.to_dict() for name, h in self.histograms.items()}
+        }
+
+
+class RouteMetrics:
+    """ RouteStats of every route of one process. The lock is held only to update the
+    numbers, once when a request starts and once when it's done. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.pid = None
+        self.filename = None
+        self.last_flush = 0
+
+    def start(self, stats):
+        with self.lock:
+            route = self.routes.get(stats.route)
+            if route is None:
+                route = self.routes[stats.route] = RouteStats(stats.resource, stats.method)
+            route.in_flight += 1
+
+    def observe(self, stats, status, values):
+        with self.lock:
+            route = self.routes[stats.route]
+            route.in_flight -= 1
+            route.statuses[status] = route.statuses.get(status, 0) + 1
+            for name, value in values.items():
+                route.histograms[name].observe(value)
+
+    def snapshot(self):
+        """ Returns {route: {metric: histogram dict}} of the requests so far """
+        with self.lock:
+            return {route: {name: h.to_dict() for name, h in stats.histograms.items()}
+                    for route, stats in self.routes.items()}
+
+    def to_dict(self):
+        """ Returns {route: RouteStats dict} of the requests so far """
+        with self.lock:
+            return {route: stats.to_dict() for route, stats in self.routes.items()}
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def flush(self, directory):
+        """ Writes the aggregates of this process into its own file of the directory """
+        if self.pid != os.getpid():
+            # first flush of this process, e.g. of a worker forked after the app was created
+            self.pid = os.getpid()
+            self.filename = os.path.join(directory, '{}-{}.json'.format(self.pid, time.time_ns()))
+            atexit.register(self.flush, directory)
+        self.last_flush = time.monotonic()
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, self.filename)
+
+    def maybe_flush(self, directory, interval):
+        if directory is not None and time.monotonic() - self.last_flush >= interval:
+            self.flush(directory)
+
+
+def route_metrics(app=None):
+    """ Returns the RouteMetrics of the app, the current app by default """
+    if app is None:
+        app = current_app
+    return app.extensions.setdefault('tapi_metrics', RouteMetrics())
+
+
+def resource_label(resource):
+    """ Decorator for the plain routes of a resource, so that they are labelled
+    by the resource instead of by the name of the route function """
+    def decorator(func):
+        func.resource = resource.__name__
+        return func
+    return decorator
+
+
+class RequestStats:
+    def __init__(self, route, resource, method):
+        self.route = route
+        self.resource = resource
+        self.method = method
+        self.start = time.perf_counter()
+        self.pool_wait = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+
+def current_stats():
+    # None outside of an instrumented request
+    if not has_app_context():
+        return None
+    return g.get('request_stats')
+
+
+@api_blueprint.before_request
+def start_request_stats():
+    if current_app.config["INSTRUMENTATION"]:
+        rule = request.url_rule.rule if request.url_rule is not None else request.path
+        view = current_app.view_functions.get(request.endpoint)
+        resource = getattr(view, 'resource', None) or getattr(view, 'view_class', view).__name__
+        g.request_stats = RequestStats(request.method + ' ' + rule, resource, request.method)
+        route_metrics().start(g.request_stats)
+
+
+@api_blueprint.after_request
+def add_request_stats(resp):
+    # g outlives the request if the app context was pushed before it
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return resp
+
+    wall_time = time.perf_counter() - stats.start
+    resp.headers['Server-Timing'] = \
+        'app;dur={:.2f}, pool;dur={:.2f}, sql;dur={:.2f};desc="{} queries"'.format(
+            wall_time * 1000, stats.pool_wait * 1000, stats.sql_time * 1000, stats.sql_count)
+    resp.headers['Timing-Allow-Origin'] = request.headers.get('Origin', '*')
+
+    metrics = route_metrics()
+    directory = current_app.config["METRICS_DIR"]
+    interval = current_app.config["METRICS_FLUSH_INTERVAL"]
+
+    def record(wall_time, size):
+        metrics.observe(stats, resp.status_code, {
+            'wall_time': wall_time,
+            'pool_wait': stats.pool_wait,
+            'sql_count': stats.sql_count,
+            'sql_time': stats.sql_time,
+            'response_bytes': size
+        })
+        metrics.maybe_flush(directory, interval)
+
+    if not resp.is_streamed:
+        record(wall_time, resp.calculate_content_length() or 0)
+        return resp
+
+    # a streamed body is built while it's sent, it's recorded once the last chunk is out
+    g.request_stats = stats
+
+    def record_stream(chunks):
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if has_app_context():
+                g.pop('request_stats', None)
+            record(time.perf_counter() - stats.start, size)
+
+    resp.response = record_stream(resp.iter_encoded())
+    return resp
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_sql_timing(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def add_sql_timing(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    starts = conn.info.get('query_start')
+    if stats is None or not starts:
+        return
+    stats.sql_count += 1
+    stats.sql_time += time.perf_counter() - starts.pop()
+
+
+class TimedPool:
+    """ Pool mixin that adds the time of getting a connection to the current request """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.pool_wait += time.perf_counter() - start
+
+
+TIMED_POOLS = {}
+
+
+def init_pool_timing(app):
+    """ Makes the pool of the app engine a TimedPool of its own pool class """
+    pool = db.get_engine(app).pool
+    cls = type(pool)
+    if cls not in TIMED_POOLS:
+        TIMED_POOLS[cls] = type('Timed' + cls.__name__, (TimedPool, cls), {})
+    # unlike the pool instance, the class survives the recreation of the pool on dispose()
+    pool.__class__ = TIMED_POOLS[cls]
+
+
+def worker_metrics(directory):
+    """ Yields (RouteMetrics dict, alive) of every worker that has written its aggregates """
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                routes = json.load(f)
+        except (OSError, ValueError):
+            continue
+        try:
+            os.kill(int(name.split('-')[0]), 0)
+            alive = True
+        except (OSError, ValueError):
+            alive = False
+        yield routes, alive
+
+
+def merge_metrics(workers):
+    """ Sums up the RouteMetrics dicts of the workers. The counters and histograms of the
+    workers that are gone are kept, the requests in flight only of the live ones. """
+    merged = {}
+    for routes, alive in workers:
+        for route, stats in routes.items():
+            if not alive:
+                stats['in_flight'] = 0
+            total = merged.get(route)
+            if total is None:
+                merged[route] = copy.deepcopy(stats)
+                continue
+            total['in_flight'] += stats['in_flight']
+            for status, n in stats['statuses'].items():
+                total['statuses'][status] = total['statuses'].get(status, 0) + n
+            for name, h in stats['histograms'].items():
+                t = total['histograms'][name]
+                t['counts'] = [a + b for a, b in zip(t['counts'], h['counts'])]
+                t['sum'] += h['sum']
+                t['count'] += h['count']
+    return merged
+
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+
+def render_prometheus(routes):
+    """ Returns the merged RouteMetrics dicts in the Prometheus text exposition format """
+    labels = {route: [('resource', stats['resource']), ('method', stats['method']),
+                      ('route', route.split(' ', 1)[1])]
+              for route, stats in routes.items()}
+    routes = sorted(routes.items())
+
+    lines = ['# HELP tapi_requests_total Requests handled', '# TYPE tapi_requests_total counter']
+    for route, stats in routes:
+        for status, n in sorted(stats['statuses'].items()):
+            lines.append('tapi_requests_total{} {}'.format(
+                format_labels(labels[route] + [('status', status)]), n))
+
+    lines += ['# HELP tapi_requests_in_flight Requests being handled', '# TYPE tapi_requests_in_flight gauge']
+    for route, stats in routes:
+        lines.append('tapi_requests_in_flight{} {}'.format(format_labels(labels[route]), stats['in_flight']))
+
+    for name, (metric, help_text) in PROMETHEUS_HISTOGRAMS.items():
+        lines += ['# HELP {} {}'.format(metric, help_text), '# TYPE {} histogram'.format(metric)]
+        for route, stats in routes:
+            h = stats['histograms'][name]
+            cumulative = 0
+            for bound, n in zip(h['bounds'] + ['+Inf'], h['counts']):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(
+                    metric, format_labels(labels[route] + [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(metric, format_labels(labels[route]), h['sum']))
+            lines.append('{}_count{} {}'.format(metric, format_labels(labels[route]), h['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_metrics():
+    """ View of /metrics, with METRICS_DIR the aggregates of all the workers """
+    if not current_app.config["INSTRUMENTATION"]:
+        return error_404()
+    metrics = route_metrics()
+    directory = current_app.config["METRICS_DIR"]
+    if directory is None:
+        routes = merge_metrics([(metrics.to_dict(), True)])
+    else:
+        metrics.flush(directory)
+        routes = merge_metrics(worker_metrics(directory))
+    return Response(render_prometheus(routes), 200, mimetype=PROMETHEUS_TEXT)
@@ -5,18 +5,79 @@ An example from the exercise taken as a base and then modified (Measurement exam
 """
 
 # BEGIN of the content taken from the exercise example
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, inspect
 from sqlalchemy.orm import relationship, backref
 # END of the content taken from the exercise example
 # now group's own content from here on.
+import datetime
+import itertools
+
+from sqlalchemy import event, func, literal_column, select
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import column_property
 
 from tapi import db
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class EpochMicroseconds(TypeDecorator):
+    """ Naive datetime stored as the integer microseconds since the epoch. SQLite compares and
+    buckets the integers instead of the text of DateTime, and reading a row parses nothing. """
+    impl = db.Integer
+
+    @property
+    def python_type(self):
+        return datetime.datetime
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return (value - EPOCH) // MICROSECOND
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return EPOCH + datetime.timedelta(microseconds=value)
+
+
+# microseconds per second, inline: a bound value would be coerced to EpochMicroseconds.
+# An integer, so the division gives whole seconds: SQLite would round a float to milliseconds
+# and put the last half millisecond of a day into the next day
+MICROSECONDS = literal_column('1000000')
+
+
+def epoch_strftime(format, column):
+    """ SQL strftime of an EpochMicroseconds column """
+    return func.strftime(format, column / MICROSECONDS, 'unixepoch')
+
+
+def epoch_date(column):
+    """ SQL date (YYYY-MM-DD) of an EpochMicroseconds column """
+    return func.date(column / MICROSECONDS, 'unixepoch')
+
+
+def handle_property(model, key_column):
+    """ The id of the model row that the integer key column refers to, loaded with the row.
+    The id can also be set, the key is looked up when the row is flushed, see resolve_handles. """
+    return column_property(select([model.id]).where(model.key == key_column).correlate_except(model).as_scalar())
+
+
+def key_of(model, handle):
+    """ SQL expression of the integer key of the model row with the given id """
+    return select([model.key]).where(model.id == handle).as_scalar()
+
+
 class Person(db.Model):
-    """ Person- All columns required """
-    id = db.Column(db.String(128), primary_key=True)
+    """ Person- All columns required. The integer key is internal, the high-volume
+    tables refer to the person with it instead of the id. AUTOINCREMENT, so that the key of a
+    deleted row is never given to a new one while rows that refer to it may be left behind """
+    __table_args__ = {'sqlite_autoincrement': True}
+    key = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(128), nullable=False, unique=True)
 
 
 class Activity(db.Model):
@@ -36,32 +97,50 @@ class ActivityRecord(db.Model):
     person = relationship(Person, backref=backref("activities", cascade="all, delete-orphan"))
     activity = relationship(Activity, backref=backref("activityrecords"))
     duration = db.Column(db.Integer, nullable=False)
-    timestamp = db.Column(db.DateTime, primary_key=True)
+    timestamp = db.Column(EpochMicroseconds, primary_key=True)
 
 
 class Meal(db.Model):
-    """  id, name and servings required """
-    id = db.Column(db.String(128), primary_key=True)
+    """  id, name and servings required, the integer key is internal like in Person """
+    __table_args__ = {'sqlite_autoincrement': True}
+    key = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(128), nullable=False, unique=True)
     name = db.Column(db.String(128), nullable=False)
     servings = db.Column(db.Float, nullable=False)
     # Description max size 8K for simplicity reasons
     description = db.Column(db.String(8*1024), nullable=True)
     meal_records = relationship("MealRecord", cascade="all, delete-orphan")
-    portions = relationship("MealPortion", cascade="all, delete-orphan")
+    portions = relationship("MealPortion", cascade="all, delete-orphan", backref="meal")
 
 
 class MealRecord(db.Model):
-    """ MealRecord- All columns required """
-    person_id = db.Column(db.String(128), ForeignKey('person.id'), primary_key=True)
-    meal_id = db.Column(db.String(128), ForeignKey('meal.id'), primary_key=True)
+    """ MealRecord- All columns required. A record is identified by the person, the meal and
+    the timestamp, stored as the integer keys of the person and the meal. person_id and
+    meal_id read and set them as the ids. """
+    __table_args__ = (
+        # The unique key, in the order of the records of a person by time and time range filters
+        db.Index('ix_meal_record_person_timestamp', 'person_key', 'timestamp', 'meal_key', unique=True),
+        # Records of a meal, when a change of the meal fans out to the nutrition rollup
+        db.Index('ix_meal_record_meal', 'meal_key', 'person_key', 'timestamp'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    person_key = db.Column(db.Integer, ForeignKey('person.key'), nullable=False)
+    meal_key = db.Column(db.Integer, ForeignKey('meal.key'), nullable=False)
     person = relationship(Person, backref=backref("meals", cascade="all, delete-orphan"))
     meal = relationship(Meal, backref=backref("mealrecords"))
     amount = db.Column(db.Float, nullable=False)
-    timestamp = db.Column(db.DateTime, primary_key=True)
+    timestamp = db.Column(EpochMicroseconds, nullable=False)
+
+
+MealRecord.person_id = handle_property(Person, MealRecord.person_key)
+MealRecord.meal_id = handle_property(Meal, MealRecord.meal_key)
 
 
 class Portion(db.Model):
-    id = db.Column(db.String(128), primary_key=True)
+    """ The integer key is internal like in Person """
+    __table_args__ = {'sqlite_autoincrement': True}
+    key = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(128), nullable=False, unique=True)
     name = db.Column(db.String(128), nullable=False)
     calories = db.Column(db.Float, nullable=False)
     density = db.Column(db.Float, nullable=True)
@@ -72,6 +151,175 @@ class Portion(db.Model):
 
 
 class MealPortion(db.Model):
-    meal_id = db.Column(db.String(128), ForeignKey('meal.id'), primary_key=True)
-    portion_id = db.Column(db.String(128), ForeignKey('portion.id'), primary_key=True)
+    """ MealPortion- a Portion in a Meal, stored as the integer keys of the Meal and the
+    Portion like in MealRecord """
+    __table_args__ = (
+        db.UniqueConstraint('meal_key', 'portion_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    meal_key = db.Column(db.Integer, ForeignKey('meal.key'), nullable=False)
+    portion_key = db.Column(db.Integer, ForeignKey('portion.key'), nullable=False)
     weight_per_serving = db.Column(db.Float, nullable=False)
+
+    portion = relationship(Portion)
+
+
+MealPortion.meal_id = handle_property(Meal, MealPortion.meal_key)
+MealPortion.portion_id = handle_property(Portion, MealPortion.portion_key)
+
+
+class NutritionRollup(db.Model):
+    """ NutritionRollup- nutrients eaten by a person per day. Derived from MealRecords,
+    MealPortions and Portions and kept current on every flush, see tapi.rollup """
+    person_key = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    calories = db.Column(db.Float, nullable=False, default=0)
+    protein = db.Column(db.Float, nullable=False, default=0)
+    carbohydrate = db.Column(db.Float, nullable=False, default=0)
+    fat = db.Column(db.Float, nullable=False, default=0)
+    alcohol = db.Column(db.Float, nullable=False, default=0)
+
+
+NutritionRollup.person_id = handle_property(Person, NutritionRollup.person_key)
+
+
+# The ids that are set on the rows instead of the keys: (id, key column, relationship, model)
+HANDLES = {
+    MealRecord: [('person_id', 'person_key', 'person', Person), ('meal_id', 'meal_key', 'meal', Meal)],
+    MealPortion: [('meal_id', 'meal_key', 'meal', Meal), ('portion_id', 'portion_key', 'portion', Portion)]
+}
+
+
+def find_by_id(session, model, handle):
+    # the row can be new in this flush, then it has no key yet
+    for obj in session.new:
+        if isinstance(obj, model) and obj.id == handle:
+            return obj
+    with session.no_autoflush:
+        return session.query(model).filter(model.id == handle).first()
+
+
+@event.listens_for(db.session, 'before_flush')
+def resolve_handles(session, flush_context, instances):
+    """ Sets the keys of the ids set on the rows. An unknown id leaves the key NULL, so the
+    flush fails with an IntegrityError like with a foreign key. """
+    for obj in itertools.chain(session.new, session.dirty):
+        for attr, key_attr, relation, model in HANDLES.get(type(obj), ()):
+            added = inspect(obj).attrs[attr].history.added
+            if not added:
+                continue
+            target = find_by_id(session, model, added[0])
+            if target is None:
+                setattr(obj, key_attr, None)
+            elif target.key is None:
+                setattr(obj, relation, target)
+            else:
+                setattr(obj, key_attr, target.key)
+
+
+class TableVersion(db.Model):
+    """ TableVersion- change counter of a table, bumped on every flush that writes to the table.
+    Used for the ETags of the resources, see tapi.versions """
+    name = db.Column(db.String(128), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def create_missing_indexes(engine):
+    """ create_all skips the tables that exist already, so add their new indexes here """
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+# SQL of the integer microseconds of a DateTime stored as text, YYYY-MM-DD HH:MM:SS.ffffff
+# (strftime %s rounds the fraction of the seconds, so it gets the whole seconds only)
+TEXT_TO_EPOCH = "(CAST(strftime('%s', substr({0}, 1, 19)) AS INTEGER) * 1000000 + CAST(substr({0}, 21, 6) AS INTEGER))"
+
+# The tables that moved from the string ids to the integer keys, in the order they are copied
+KEYED_TABLES = ['person', 'meal', 'portion', 'meal_portion', 'meal_record', 'nutrition_rollup']
+
+# Copies of the rows of the renamed tables, the ids looked up as the keys
+KEYED_COPIES = [
+    "INSERT INTO meal_portion (meal_key, portion_key, weight_per_serving) "
+    "SELECT meal.key, portion.key, old.weight_per_serving FROM legacy_meal_portion AS old "
+    "JOIN meal ON meal.id = old.meal_id JOIN portion ON portion.id = old.portion_id",
+    "INSERT INTO meal_record (person_key, meal_key, amount, timestamp) "
+    "SELECT person.key, meal.key, old.amount, " + TEXT_TO_EPOCH.format("old.timestamp") +
+    " FROM legacy_meal_record AS old "
+    "JOIN person ON person.id = old.person_id JOIN meal ON meal.id = old.meal_id"
+]
+
+
+def rebuild_tables(engine, names, copies):
+    """ Renames the existing tables of the given names, creates them in their current layout and
+    fills them with the copies, SQL statements that read the renamed legacy_<name> tables """
+    with engine.connect() as connection:
+        # legacy_alter_table keeps the references of the other tables to the renamed ones
+        connection.execute("PRAGMA foreign_keys=OFF")
+        connection.execute("PRAGMA legacy_alter_table=ON")
+        existing = set(engine.table_names())
+        with connection.begin():
+            renamed = [name for name in names if name in existing]
+            for name in renamed:
+                for index in inspect(connection).get_indexes(name):
+                    connection.execute('DROP INDEX "{}"'.format(index['name']))
+                connection.execute('ALTER TABLE "{0}" RENAME TO "legacy_{0}"'.format(name))
+            db.metadata.create_all(connection, tables=[db.metadata.tables[name] for name in names])
+            for copy in copies:
+                connection.execute(copy)
+            for name in reversed(renamed):
+                connection.execute('DROP TABLE "legacy_{}"'.format(name))
+        connection.execute("PRAGMA legacy_alter_table=OFF")
+
+
+def upgrade_to_integer_keys(engine):
+    """ Moves a DB of the string keyed layout to the integer keys: the old tables are renamed,
+    the new ones created and the rows copied over. The rows that refer to missing ids are
+    dropped. Returns True if the DB was upgraded, then the rollup should be rebuilt. """
+    if 'person' not in engine.table_names():
+        return False
+    if 'key' in {c['name'] for c in inspect(engine).get_columns('person')}:
+        return False
+    copies = []
+    for name in ['person', 'meal', 'portion']:
+        columns = ", ".join(c.name for c in db.metadata.tables[name].columns if c.name != 'key')
+        copies.append("INSERT INTO {0} ({1}) SELECT {1} FROM legacy_{0}".format(name, columns))
+    rebuild_tables(engine, KEYED_TABLES, copies + KEYED_COPIES)
+    return True
+
+
+def upgrade_autoincrement_keys(engine):
+    """ Rebuilds the tables of the integer keys that were created without AUTOINCREMENT, which
+    let SQLite give the key of a deleted row to a new row. The keys are copied as they are. """
+    tables = set(engine.table_names())
+    for model in [Person, Meal, Portion]:
+        table = model.__table__
+        if table.name not in tables:
+            continue
+        sql = engine.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                             table.name).scalar()
+        if 'AUTOINCREMENT' in sql.upper():
+            continue
+        columns = ", ".join(c.name for c in table.columns)
+        rebuild_tables(engine, [table.name], ["INSERT INTO {0} ({1}) SELECT {1} FROM legacy_{0}".format(
+            table.name, columns)])
+
+
+def upgrade_epoch_timestamps(engine):
+    """ Moves the record tables whose timestamps are stored as DateTime text to EpochMicroseconds """
+    tables = set(engine.table_names())
+    inspector = inspect(engine)
+    for model in [MealRecord, ActivityRecord]:
+        table = model.__table__
+        if table.name not in tables:
+            continue
+        stored = {c['name']: c['type'] for c in inspector.get_columns(table.name)}
+        if isinstance(stored['timestamp'], db.Integer):
+            continue
+        columns = [c.name for c in table.columns]
+        values = [TEXT_TO_EPOCH.format(c) if c == 'timestamp' else c for c in columns]
+        rebuild_tables(engine, [table.name], ["INSERT INTO {0} ({1}) SELECT {2} FROM legacy_{0}".format(
+            table.name, ", ".join(columns), ", ".join(values))])
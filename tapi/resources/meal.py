@@ -1,18 +1,32 @@
-import json
-
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import SchemaError, ValidationError
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import Meal
+from tapi.models import Meal, MealPortion, MealRecord, Portion, NutritionRollup
 from tapi.utils import add_mason_response_header, add_calorie_namespace, meal_to_api_meal
-from tapi.utils import CalorieBuilder
-from tapi.utils import error_400, error_404, error_409, error_415
+from tapi.utils import mealportion_to_api_mealportion, portion_to_api_portion, make_mealportion_handle
+from tapi.utils import requested_expansions
+from tapi.utils import CalorieBuilder, ControlTemplate, KeysetPage, collection_response, mason_response, url_template
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_415
 from tapi.constants import MASON, NS
 from tapi import db
+from tapi.versions import conditional_get, bump_versions
+from tapi.catalogue import catalogue_row, invalidate_catalogue
+from tapi.rollup import meal_days, refresh_rollup
+from tapi.validators import register_validator
 from tapi.api import api
+from tapi.resources.portion import PortionItem
+
+
+# ?expand= names of Meal and the models of the related resources they embed
+MEAL_EXPANSIONS = {
+    'portions': [MealPortion],
+    'portions.portion': [Portion]
+}
 
 
 # MealItem type specific helper functions
@@ -45,63 +59,161 @@ def meal_schema():
     return schema
 
 
+MEAL_VALIDATOR = register_validator("meal", meal_schema())
+
+
 def add_control_add_meal(resp):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":add-meal",
         href=api.url_for(MealItem, handle=None),
         method="POST",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Creates a new Meal",
-        schema=meal_schema()
+        schema_name="meal"
     )
 
 
 def add_control_edit_meal(resp, handle):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":edit-meal",
         href=api.url_for(MealItem) + handle + '/',
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a Meal",
-        schema=meal_schema()
+        schema_name="meal"
     )
 
 
+def meal_item_controls():
+    # controls of the items of the Meal collection
+    m = CalorieBuilder()
+    m.add_control_self(url_template(MealItem, 'handle'))
+    m.add_control_collection(api.url_for(MealItem, handle=None))
+    add_control_edit_meal(m, handle='{handle}')
+    return ControlTemplate(m)
+
+
+def meal_collection_item(meal, controls, expansions=None):
+    m = controls.add_to(meal_to_api_meal(meal), handle=meal.id)
+    if expansions is not None:
+        expansions.add_to(m, meal)
+    return m
+
+
+def meal_loader_options(expand, load=None):
+    """ Eager loading options of the expansions: the MealPortions of all the Meals of the query
+    come with one more SELECT, their Portions joined to it. load is the loader option of the
+    relationship the Meals are loaded through when they are not the entities of the query. """
+    if 'portions' not in expand:
+        return [load] if load is not None else []
+    portions = selectinload(Meal.portions) if load is None else load.selectinload(Meal.portions)
+    if 'portions.portion' in expand:
+        portions = portions.joinedload(MealPortion.portion)
+    return [portions]
+
+
+def delete_meal(meal_id):
+    """ Deletes the Meal with its MealRecords and MealPortions, each table with one DELETE,
+    instead of loading every child row through the cascades of the relationships.
+    Core deletes skip the flush hooks, so the rollup and the versions are updated here. """
+    connection = db.session.connection()
+    meal_key = connection.execute(select([Meal.key]).where(Meal.id == meal_id)).scalar()
+    keys = meal_days(connection, [meal_key])
+    deletes = [
+        (MealRecord.__table__, MealRecord.meal_key == meal_key),
+        (MealPortion.__table__, MealPortion.meal_key == meal_key),
+        (Meal.__table__, Meal.key == meal_key)
+    ]
+    tables = [table.name for table, where in deletes if connection.execute(table.delete().where(where)).rowcount]
+    refresh_rollup(connection, keys)
+    if keys:
+        tables.append(NutritionRollup.__tablename__)
+    bump_versions(connection, tables)
+    db.session.commit()
+
+
+class MealExpansions:
+    """ Embeds the expanded related resources in the API Meals of a response. The Meals should
+    be loaded with meal_loader_options so that embedding doesn't query the DB per Meal. """
+    def __init__(self, expand):
+        # mealportion imports this module
+        from tapi.resources.mealportion import MealPortionItem
+        self.expand = expand
+        mp = CalorieBuilder()
+        mp.add_control_self(url_template(MealPortionItem, 'meal', 'handle'))
+        self.mealportion_controls = ControlTemplate(mp)
+        p = CalorieBuilder()
+        p.add_control_self(url_template(PortionItem, 'handle'))
+        self.portion_controls = ControlTemplate(p)
+
+    def add_to(self, m, meal):
+        if 'portions' in self.expand:
+            # the Portion can be deleted without its MealPortions, they are left out like in
+            # the MealPortion collection. Their portion_id is read from the Portion, so it's None
+            m['portions'] = [self.mealportion(mealportion) for mealportion in meal.portions
+                             if mealportion.portion_id is not None]
+        return m
+
+    def mealportion(self, mealportion, portion=None):
+        # portion is the Portion of the MealPortion if it's already at hand, e.g. from the catalogue
+        mp = self.mealportion_controls.add_to(
+            mealportion_to_api_mealportion(mealportion), meal=mealportion.meal_id,
+            handle=make_mealportion_handle(mealportion.meal_id, mealportion.portion_id))
+        if 'portions.portion' in self.expand:
+            if portion is None:
+                portion = mealportion.portion
+            mp['portion'] = self.portion_controls.add_to(portion_to_api_portion(portion),
+                                                         handle=mealportion.portion_id)
+        return mp
+
+
 class MealItem(Resource):
     """ MealItem servers both: Individual MealItem and Meal Collection
     If given handle is missing, the Meal Collection is returned. If handle is
     given, the corresponding MealItem is returned (if found from the DB) """
     @classmethod
+    @conditional_get(Meal, expansions=MEAL_EXPANSIONS)
     def get(cls, handle=None):
+        try:
+            expand = requested_expansions(MEAL_EXPANSIONS)
+        except ValueError:
+            return error_400_query()
+        query = Meal.query.options(*meal_loader_options(expand))
+        expansions = MealExpansions(expand) if expand else None
         if handle is None:
             # Meal collection
+            try:
+                page = KeysetPage(query, [Meal.id])
+            except ValueError:
+                return error_400_query()
             resp = CalorieBuilder(items=[])
-            for meal in Meal.query.all():
-                m = meal_to_api_meal(meal)
-                m.add_control_self(api.url_for(MealItem, handle=meal.id))
-                m.add_control_collection(api.url_for(MealItem, handle=None))
-                add_control_edit_meal(m, handle=meal.id)
-
-                resp['items'].append(m)
             add_control_add_meal(resp)
         else:
             # Meal item
-            meal = Meal.query.filter(Meal.id == handle).first()
+            # the embedded resources are loaded with the Meal, the catalogue has the Meal only
+            meal = query.filter(Meal.id == handle).first() if expand else catalogue_row(Meal, handle)
             if meal is None:
                 return error_404()
             resp = meal_to_api_meal(meal)
+            if expansions is not None:
+                expansions.add_to(resp, meal)
             resp.add_control_collection(api.url_for(MealItem, handle=None))
             resp.add_control_delete(api.url_for(MealItem, handle=handle))
             resp.add_control_profile()
             add_control_edit_meal(resp, handle)
+            resp.add_control(NS + ':mealportions', api.url_for(MealItem, handle=handle) + "mealportions/")
 
         # Common fields for person item and person collection
         resp.add_control_self(api.url_for(MealItem, handle=handle))
         resp.add_control(NS+':meals-all', api.url_for(MealItem, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        if handle is None:
+            controls = meal_item_controls()
+            return collection_response(resp, page, lambda meal: meal_collection_item(meal, controls, expansions),
+                                       api.url_for(MealItem, handle=None), meal_to_api_meal)
+        return mason_response(resp)
 
     @classmethod
     def post(cls):
@@ -112,7 +224,7 @@ class MealItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=meal_schema())
+            MEAL_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
@@ -135,6 +247,7 @@ class MealItem(Resource):
         except IntegrityError:
             db.session.rollback()
             return error_409()
+        invalidate_catalogue(Meal)
 
         h = add_mason_response_header()
         h.add('Location', api.url_for(MealItem, handle=meal.id))
@@ -153,7 +266,7 @@ class MealItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=meal_schema())
+            MEAL_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
@@ -174,6 +287,7 @@ class MealItem(Resource):
         except IntegrityError:
             db.session.rollback()
             return error_409()
+        invalidate_catalogue(Meal)
 
         return Response(
             response="",
@@ -186,6 +300,6 @@ class MealItem(Resource):
         meal = Meal.query.filter(Meal.id == handle).first()
         if meal is None:
             return error_404()
-        db.session.delete(meal)
-        db.session.commit()
+        delete_meal(handle)
+        invalidate_catalogue(Meal)
         return Response("DELETED", 204, mimetype=MASON)
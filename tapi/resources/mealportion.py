@@ -1,18 +1,21 @@
-import json
-
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import SchemaError, ValidationError
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import Meal, MealPortion, Portion
-from tapi.resources.meal import MealItem
+from tapi.models import Meal, MealPortion, Portion, key_of
+from tapi.resources.meal import MealItem, MealExpansions
 from tapi.utils import add_mason_response_header, add_calorie_namespace, \
-    mealportion_to_api_mealportion, make_mealportion_handle
+    mealportion_to_api_mealportion, make_mealportion_handle, mason_response
+from tapi.utils import CalorieBuilder
 from tapi.utils import error_400, error_404, error_409, error_415
-from tapi.constants import MASON, NS
+from tapi.constants import MASON, NS, NUTRIENTS
 from tapi import db
+from tapi.versions import conditional_get
+from tapi.catalogue import catalogue, catalogue_row
+from tapi.validators import register_validator
 from tapi.api import api
 
 
@@ -42,18 +45,45 @@ def mealportion_schema():
     return schema
 
 
+MEALPORTION_VALIDATOR = register_validator("mealportion", mealportion_schema())
+
+
 def add_control_edit_mealportion(resp, meal, handle):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":edit-mealportion",
         href=api.url_for(MealPortionItem, meal=meal, handle=handle),
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a MealPortion",
-        schema=mealportion_schema()
+        schema_name="mealportion"
+    )
+
+
+def add_control_add_mealportion(resp, meal_id):
+    resp.add_control_with_schema(
+        NS + ":add-mealportion",
+        href=api.url_for(MealItem, handle=meal_id) + "mealportions/",
+        method="POST",
+        encoding="json",
+        title="Adds a Portion to the Meal",
+        schema_name="mealportion"
     )
 
 
+def mealportion_nutrients(mealportion, portion):
+    # nutrients of the portion in one serving of the meal, the portion values are per 100g
+    return {n: mealportion.weight_per_serving * (getattr(portion, n) or 0) / 100
+            for n in NUTRIENTS}
+
+
+def find_mealportion(meal_id, portion_id):
+    # the MealPortion of a handle, looked up with the keys of the meal and the portion
+    return MealPortion.query.filter(
+        MealPortion.meal_key == key_of(Meal, meal_id),
+        MealPortion.portion_key == key_of(Portion, portion_id)).first()
+
+
 def decode_handle(meal, handle):
     d = handle.split(meal + '-')
     return meal, d[1]
@@ -61,13 +91,12 @@ def decode_handle(meal, handle):
 
 class MealPortionItem(Resource):
     @classmethod
+    @conditional_get(MealPortion, Portion)
     def get(cls, meal, handle):
         # MealPortion
         meal_id, portion_id = decode_handle(meal, handle)
 
-        mealportion = MealPortion.query.filter(
-            MealPortion.meal_id == meal_id,
-            MealPortion.portion_id == portion_id).first()
+        mealportion = find_mealportion(meal_id, portion_id)
         if mealportion is None:
             return error_404()
         resp = mealportion_to_api_mealportion(mealportion)
@@ -79,7 +108,48 @@ class MealPortionItem(Resource):
 
         resp.add_control_self(api.url_for(MealPortionItem, meal=meal, handle=handle))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        return mason_response(resp)
+
+    @classmethod
+    @conditional_get(Meal, MealPortion, Portion)
+    def get_portions_for_meal(cls, handle):
+        """ The MealPortion collection of a Meal: the MealPortions with their Portions embedded,
+        and the nutrients of every MealPortion and of the whole Meal, both per serving and in all
+        the servings of the Meal. The Meal and the Portions come from the catalogues, or the
+        Portions are loaded with the MealPortions if the catalogue is not cached. MealPortions of
+        deleted Portions are left out, like in the nutrition aggregates. """
+        meal = catalogue_row(Meal, handle)
+        if meal is None:
+            return error_404()
+        portions = catalogue(Portion)
+        query = MealPortion.query.join(MealPortion.portion) \
+            .filter(MealPortion.meal_key == meal.key).order_by(MealPortion.portion_id)
+        if portions is None:
+            query = query.options(contains_eager(MealPortion.portion))
+
+        expansions = MealExpansions({'portions', 'portions.portion'})
+        totals = dict.fromkeys(NUTRIENTS, 0)
+        items = []
+        for mealportion in query:
+            portion = portions.by_key.get(mealportion.portion_key) if portions is not None else None
+            if portion is None:
+                # a Portion added after the catalogue was read
+                portion = mealportion.portion
+            item = expansions.mealportion(mealportion, portion)
+            item['nutrients_per_serving'] = nutrients = mealportion_nutrients(mealportion, portion)
+            for n in NUTRIENTS:
+                totals[n] += nutrients[n]
+            items.append(item)
+
+        href = api.url_for(MealItem, handle=handle) + "mealportions/"
+        resp = CalorieBuilder(meal_id=handle, servings=meal.servings, items=items,
+                              nutrients_per_serving=totals,
+                              nutrients={n: totals[n] * meal.servings for n in NUTRIENTS})
+        resp.add_control_self(href)
+        resp.add_control('up', api.url_for(MealItem, handle=handle))
+        add_control_add_mealportion(resp, handle)
+        add_calorie_namespace(resp)
+        return mason_response(resp)
 
     @classmethod
     def post(cls, handle):
@@ -90,7 +160,7 @@ class MealPortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealportion_schema())
+            MEALPORTION_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
@@ -128,14 +198,12 @@ class MealPortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealportion_schema())
+            MEALPORTION_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
         meal_id, portion_id = decode_handle(meal, handle)
-        mealportion = MealPortion.query.filter(
-            MealPortion.meal_id == meal_id,
-            MealPortion.portion_id == portion_id).first()
+        mealportion = find_mealportion(meal_id, portion_id)
         if mealportion is None:
             return error_404()
 
@@ -158,9 +226,7 @@ class MealPortionItem(Resource):
     @classmethod
     def delete(cls, meal, handle):
         meal_id, portion_id = decode_handle(meal, handle)
-        mealportion = MealPortion.query.filter(
-            MealPortion.meal_id == meal_id,
-            MealPortion.portion_id == portion_id).first()
+        mealportion = find_mealportion(meal_id, portion_id)
         if mealportion is None:
             return error_404()
         db.session.delete(mealportion)
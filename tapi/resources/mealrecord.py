@@ -1,19 +1,40 @@
 import json
-import datetime
 
-from flask import Response, request
+from flask import Response, request, current_app
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import SchemaError, ValidationError
+from sqlalchemy import and_, or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import MealRecord
-from tapi.utils import add_mason_response_header, add_calorie_namespace, mealrecord_to_api_mealrecord, myconverter
-from tapi.utils import CalorieBuilder, make_mealrecord_handle
-from tapi.utils import error_400, error_404, error_409, error_415
-from tapi.constants import MASON, NS
+from tapi.models import MealRecord, Person, Meal, key_of
+from tapi.utils import add_mason_response_header, add_calorie_namespace, mealrecord_to_api_mealrecord, mason_response
+from tapi.utils import meal_to_api_meal, requested_expansions, url_template, parse_time_arg, parse_timestamp
+from tapi.utils import CalorieBuilder, ControlTemplate, make_mealrecord_handle, KeysetPage, collection_response
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_413, error_415
+from tapi.constants import MASON, NDJSON, NS, ROUTE_ENTRYPOINT, ROUTE_PERSON_COLLECTION, ROUTE_MEALRECORD_BULK
 from tapi import db
+from tapi.versions import conditional_get, bump_versions
+from tapi.rollup import refresh_rollup
+from tapi.validators import register_validator
 from tapi.api import api
+from tapi.resources.meal import MealItem, MealExpansions, MEAL_EXPANSIONS, meal_loader_options
+
+
+# Unique key of MealRecord in the order of ix_meal_record_person_timestamp,
+# used as the pagination key of the collections so that records come in time order
+MEALRECORD_KEY = [MealRecord.person_key, MealRecord.timestamp, MealRecord.meal_key]
+
+# Columns of the rows of the Core inserts
+MEALRECORD_COLUMNS = ['person_key', 'meal_key', 'amount', 'timestamp']
+# Keys per query when looking up the existing records of a bulk request, 3 bound values each
+EXISTING_KEYS_CHUNK = 300
+
+# ?expand= names of MealRecord and the models of the related resources they embed,
+# the expansions of the Meal can be nested in 'meal'
+MEALRECORD_EXPANSIONS = {'meal': [Meal]}
+MEALRECORD_EXPANSIONS.update(('meal.' + name, models) for name, models in MEAL_EXPANSIONS.items())
 
 
 # MealRecord type specific helper functions
@@ -47,75 +68,244 @@ def mealrecord_schema():
     return schema
 
 
+MEALRECORD_VALIDATOR = register_validator("mealrecord", mealrecord_schema())
+register_validator("mealrecords", {"type": "array", "items": mealrecord_schema()})
+
+
 def split_mealrecord_handle(meal, handle):
     # deparse handle to make parameters
     meal = meal
     timestring = handle[-26:]
     person = handle[:-len(timestring)-1-len(meal)-1]
-    timestamp = datetime.datetime.strptime(timestring.replace("_", " "),
-                                           '%Y-%m-%d %H:%M:%S.%f')
+    timestamp = parse_timestamp(timestring.replace("_", " "))
     return person, meal, timestamp
 
 
 def add_control_add_mealrecord(resp):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":add-mealrecord",
         href=api.url_for(MealRecordItem, meal=None, handle=None),
         method="POST",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Creates a new MealRecord",
-        schema=mealrecord_schema()
+        schema_name="mealrecord"
     )
 
 
+def add_control_add_mealrecords(resp):
+    resp.add_control_with_schema(
+        NS + ":add-mealrecords",
+        href=ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK,
+        method="POST",
+        encoding="json",
+        title="Creates many MealRecords, as a JSON array or as NDJSON",
+        schema_name="mealrecords"
+    )
+
+
+def read_bulk_items():
+    # returns the items of a JSON array or NDJSON body, NDJSON lines that
+    # are not JSON are returned as None. Raises BadRequest on invalid body.
+    if request.mimetype == NDJSON:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        return items
+    items = request.json
+    if not isinstance(items, list):
+        raise BadRequest()
+    return items
+
+
+def parse_bulk_item(item):
+    # returns the MealRecord row of a bulk item, raises ValueError if it's not valid
+    if item is None:
+        raise ValueError("Item is not valid JSON")
+    try:
+        MEALRECORD_VALIDATOR.validate(item)
+    except (SchemaError, ValidationError) as e:
+        raise ValueError(e.message)
+    return {
+        'person_id': item['person_id'],
+        'meal_id': item['meal_id'],
+        'amount': item['amount'],
+        'timestamp': parse_timestamp(item['timestamp'])
+    }
+
+
+def find_existing_keys(rows):
+    # unique keys of the rows that are already in the DB. Only the exact keys of the rows are
+    # looked up, every one with a search of the unique index, in chunks that keep the number
+    # of the bound values within the SQLite limit
+    keys = list({mealrecord_row_key(r) for r in rows})
+    found = set()
+    for i in range(0, len(keys), EXISTING_KEYS_CHUNK):
+        found.update(db.session.query(*MEALRECORD_KEY).filter(or_(
+            *[and_(*[c == value for c, value in zip(MEALRECORD_KEY, key)])
+              for key in keys[i:i + EXISTING_KEYS_CHUNK]])))
+    return found
+
+
+def mealrecord_row_key(row):
+    # in the order of MEALRECORD_KEY
+    return row['person_key'], row['timestamp'], row['meal_key']
+
+
+def find_mealrecord(query, person_id, meal_id, timestamp):
+    # the MealRecord of a handle, looked up with the keys of the person and the meal
+    return query.filter(MealRecord.person_key == key_of(Person, person_id),
+                        MealRecord.timestamp == timestamp,
+                        MealRecord.meal_key == key_of(Meal, meal_id)).first()
+
+
 def add_control_edit_mealrecord(resp, meal, handle):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":edit-mealrecord",
         href=api.url_for(MealRecordItem, meal=meal, handle=handle),
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a MealRecord",
-        schema=mealrecord_schema()
+        schema_name="mealrecord"
     )
 
 
+def mealrecord_item_controls():
+    # controls of the items of the MealRecord collections
+    m = CalorieBuilder()
+    m.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
+    return ControlTemplate(m)
+
+
+def filter_mealrecords(query):
+    """ Applies the filters of the MealRecord collections to the query: 'from' (inclusive) and
+    'to' (exclusive) limit the timestamps, given as dates or full timestamps, and 'meal_id' picks
+    the records of one meal. They are SQL predicates on the columns of the MealRecord indexes.
+    Raises ValueError if the parameters are not valid. """
+    time_from = parse_time_arg('from')
+    time_to = parse_time_arg('to')
+    meal_id = request.args.get('meal_id')
+    if time_from is not None:
+        query = query.filter(MealRecord.timestamp >= time_from)
+    if time_to is not None:
+        query = query.filter(MealRecord.timestamp < time_to)
+    if meal_id is not None:
+        query = query.filter(MealRecord.meal_key == key_of(Meal, meal_id))
+    return query
+
+
+def mealrecord_collection_item(mealrecord, controls, expansions=None):
+    m = controls.add_to(mealrecord_to_api_mealrecord(mealrecord))
+    if expansions is not None:
+        expansions.add_to(m, mealrecord)
+    return m
+
+
+def meal_expansions(expand):
+    # the expansions nested in 'meal', as expansions of the Meal
+    return {name[len('meal.'):] for name in expand if name.startswith('meal.')}
+
+
+def mealrecord_loader_options(expand):
+    # the Meal is joined to the MealRecords, its own expansions are loaded as in MealItem
+    if 'meal' not in expand:
+        return []
+    meal_expand = meal_expansions(expand)
+    return meal_loader_options(meal_expand, joinedload(MealRecord.meal))
+
+
+class MealRecordExpansions:
+    """ Embeds the Meal, with its own expansions, in the API MealRecords of a response """
+    def __init__(self, expand):
+        m = CalorieBuilder()
+        m.add_control_self(url_template(MealItem, 'handle'))
+        self.meal_controls = ControlTemplate(m)
+        meal_expand = meal_expansions(expand)
+        self.meal_expansions = MealExpansions(meal_expand) if meal_expand else None
+
+    def add_to(self, m, mealrecord):
+        meal = self.meal_controls.add_to(meal_to_api_meal(mealrecord.meal), handle=mealrecord.meal_id)
+        if self.meal_expansions is not None:
+            self.meal_expansions.add_to(meal, mealrecord.meal)
+        m['meal'] = meal
+        return m
+
+
+def insert_mealrecords(rows):
+    """ Inserts the {index: row} rows with one executemany and returns the indexes that were
+    created. If some other request created the same records meanwhile, falls back to one
+    insert per row so that only the conflicting rows fail. """
+    if not rows:
+        return set()
+    table = MealRecord.__table__
+    values = {i: {c: row[c] for c in MEALRECORD_COLUMNS} for i, row in rows.items()}
+    try:
+        db.session.execute(table.insert(), list(values.values()))
+        created = set(rows)
+    except IntegrityError:
+        db.session.rollback()
+        created = set()
+        for i, row in values.items():
+            try:
+                if db.session.execute(table.insert().prefix_with("OR IGNORE"), row).rowcount == 1:
+                    created.add(i)
+            except IntegrityError:
+                pass
+    if created:
+        # Core inserts skip the flush hooks, so update the rollup and the version here
+        connection = db.session.connection()
+        refresh_rollup(connection, {(rows[i]['person_key'], rows[i]['timestamp'].date()) for i in created})
+        bump_versions(connection, [table.name])
+    db.session.commit()
+    return created
+
+
 class MealRecordItem(Resource):
     """ MealRecordItem serves: Individual MealRecordItem,MealRecord Collection ans MealRecord by person.
     If handle is missing, the MealRecord Collection is returned. If handle is
     given, the corresponding MealRecord is returned (if found from the DB)
-    TODO: If handle is missing but person is given, MealRecords by person are returned. """
+    If handle is missing but person is given, MealRecords by person are returned.
+    The collections are filtered with the 'from', 'to' and 'meal_id' query parameters,
+    see filter_mealrecords, and paged with 'limit', 'order' and the cursors, see KeysetPage. """
 
     @classmethod
+    @conditional_get(MealRecord, expansions=MEALRECORD_EXPANSIONS)
     def get(cls, meal=None, handle=None, person_id=None):
-
-        if handle is None and person_id is not None:
-            resp = CalorieBuilder(items=[])
-            for mealrecord in MealRecord.query.filter(MealRecord.person_id == person_id):
-               m = mealrecord_to_api_mealrecord(mealrecord)
-               m.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
-               resp['items'].append(m)
-            add_control_add_mealrecord(resp)
-
-        elif handle is None:
-            # MealRecord collection
+        try:
+            expand = requested_expansions(MEALRECORD_EXPANSIONS)
+        except ValueError:
+            return error_400_query()
+        query = MealRecord.query.options(*mealrecord_loader_options(expand))
+        expansions = MealRecordExpansions(expand) if expand else None
+
+        if handle is None:
+            # MealRecord collection, or MealRecords by person if person is given
+            href = api.url_for(MealRecordItem, meal=None, handle=None)
+            if person_id is not None:
+                query = query.filter(MealRecord.person_key == key_of(Person, person_id))
+                href = "{}{}{}/mealrecords/".format(ROUTE_ENTRYPOINT, ROUTE_PERSON_COLLECTION, person_id)
+            try:
+                page = KeysetPage(filter_mealrecords(query), MEALRECORD_KEY)
+            except ValueError:
+                return error_400_query()
             resp = CalorieBuilder(items=[])
-            for mealrecord in MealRecord.query.all():
-                m = mealrecord_to_api_mealrecord(mealrecord)
-                m.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
-                resp['items'].append(m)
             add_control_add_mealrecord(resp)
+            add_control_add_mealrecords(resp)
         else:
             # MealRecord item
             person, meal_id, timestamp = split_mealrecord_handle(meal, handle)
 
-            mealrecord = MealRecord.query.filter(MealRecord.person_id == person,
-                                                 MealRecord.meal_id == meal_id,
-                                                 MealRecord.timestamp == timestamp).first()
+            mealrecord = find_mealrecord(query, person, meal_id, timestamp)
             if mealrecord is None:
                 return error_404()
             resp = mealrecord_to_api_mealrecord(mealrecord)
+            if expansions is not None:
+                expansions.add_to(resp, mealrecord)
             resp.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
             resp.add_control_delete(api.url_for(MealRecordItem, meal=meal, handle=handle))
             resp.add_control_profile()
@@ -125,7 +315,11 @@ class MealRecordItem(Resource):
         resp.add_control_self(api.url_for(MealRecordItem, meal=meal, handle=handle))
         resp.add_control(NS+':mealrecords-all', api.url_for(MealRecordItem, meal=None, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp, default=myconverter), 200, headers=add_mason_response_header())
+        if handle is None:
+            controls = mealrecord_item_controls()
+            return collection_response(resp, page, lambda mealrecord: mealrecord_collection_item(mealrecord, controls, expansions),
+                                       href, mealrecord_to_api_mealrecord)
+        return mason_response(resp)
 
     @classmethod
     def get_records_for_person(cls, person_id):
@@ -140,7 +334,7 @@ class MealRecordItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealrecord_schema())
+            MEALRECORD_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
@@ -153,8 +347,7 @@ class MealRecordItem(Resource):
             person_id=mealrecord_person,
             meal_id=mealrecord_meal,
             amount=mealrecord_amount,
-            timestamp=datetime.datetime.strptime(mealrecord_timestamp,
-                                        '%Y-%m-%d %H:%M:%S.%f')
+            timestamp=parse_timestamp(mealrecord_timestamp)
         )
 
         db.session.add(mealrecord)
@@ -175,6 +368,60 @@ class MealRecordItem(Resource):
             headers=h
         )
 
+    @classmethod
+    def post_bulk(cls):
+        """ Creates many MealRecords in one transaction. Every item is validated on its own
+        and gets its own status: created, conflict (already exists, duplicate in the request,
+        or unknown person or meal) or invalid. The valid items are created even if others fail. """
+        try:
+            items = read_bulk_items()
+        except BadRequest:
+            return error_415()
+        if len(items) > current_app.config["MAX_BULK_ITEMS"]:
+            return error_413()
+
+        statuses = [None] * len(items)
+        rows = {}
+        for i, item in enumerate(items):
+            try:
+                rows[i] = parse_bulk_item(item)
+            except ValueError as e:
+                statuses[i] = {'index': i, 'status': 'invalid', 'message': str(e)}
+
+        if rows:
+            persons = {r['person_id'] for r in rows.values()}
+            meals = {r['meal_id'] for r in rows.values()}
+            person_keys = dict(db.session.query(Person.id, Person.key).filter(Person.id.in_(persons)))
+            meal_keys = dict(db.session.query(Meal.id, Meal.key).filter(Meal.id.in_(meals)))
+            for row in rows.values():
+                row['person_key'] = person_keys.get(row['person_id'])
+                row['meal_key'] = meal_keys.get(row['meal_id'])
+            seen = find_existing_keys([r for r in rows.values() if r['person_key'] is not None])
+            for i, row in list(rows.items()):
+                key = mealrecord_row_key(row)
+                if key in seen or row['person_key'] is None or row['meal_key'] is None:
+                    statuses[i] = {'index': i, 'status': 'conflict'}
+                    del rows[i]
+                seen.add(key)
+
+        created = insert_mealrecords(rows)
+        for i in rows:
+            row = rows[i]
+            if i in created:
+                handle = make_mealrecord_handle(row['person_id'], row['meal_id'], row['timestamp'])
+                s = CalorieBuilder(index=i, status='created')
+                s.add_control_self(api.url_for(MealRecordItem, meal=row['meal_id'], handle=handle))
+                statuses[i] = s
+            else:
+                statuses[i] = {'index': i, 'status': 'conflict'}
+
+        resp = CalorieBuilder(items=statuses)
+        for status in ('created', 'conflict', 'invalid'):
+            resp[status] = sum(1 for s in statuses if s['status'] == status)
+        resp.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
+        add_calorie_namespace(resp)
+        return mason_response(resp)
+
     @classmethod
     def put(cls, meal, handle):
         try:
@@ -184,23 +431,20 @@ class MealRecordItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealrecord_schema())
+            MEALRECORD_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
         person, meal_id, timestamp = split_mealrecord_handle(meal, handle)
 
-        mealrecord = MealRecord.query.filter(MealRecord.person_id == person,
-                                             MealRecord.meal_id == meal_id,
-                                             MealRecord.timestamp == timestamp).first()
+        mealrecord = find_mealrecord(MealRecord.query, person, meal_id, timestamp)
         if mealrecord is None:
             return error_404()
 
         mealrecord.person_id = request.json['person_id']
         mealrecord.meal_id = request.json['meal_id']
         mealrecord.amount = request.json['amount']
-        mealrecord.timestamp = datetime.datetime.strptime(request.json['timestamp'],
-                                        '%Y-%m-%d %H:%M:%S.%f')
+        mealrecord.timestamp = parse_timestamp(request.json['timestamp'])
 
         db.session.add(mealrecord)
         try:
@@ -219,9 +463,7 @@ class MealRecordItem(Resource):
     def delete(cls, meal, handle=None):
         person, meal_id, timestamp = split_mealrecord_handle(meal, handle)
 
-        mealrecord = MealRecord.query.filter(MealRecord.person_id == person,
-                                             MealRecord.meal_id == meal_id,
-                                             MealRecord.timestamp == timestamp).first()
+        mealrecord = find_mealrecord(MealRecord.query, person, meal_id, timestamp)
         if mealrecord is None:
             return error_404()
         db.session.delete(mealrecord)
@@ -0,0 +1,96 @@
+import datetime
+
+from flask import request
+from flask_restful import Resource
+from sqlalchemy import func
+
+from tapi.models import Person, MealRecord, MealPortion, Portion, NutritionRollup, epoch_strftime, key_of
+from tapi.rollup import nutrient_sums
+from tapi.utils import add_calorie_namespace
+from tapi.utils import CalorieBuilder, mason_response
+from tapi.utils import error_400_query, error_404, parse_time_arg
+from tapi.constants import NS, NUTRIENTS, NUTRITION_BUCKETS, ROUTE_ENTRYPOINT, ROUTE_PERSON_COLLECTION
+from tapi.api import api
+from tapi.versions import conditional_get
+
+
+# Nutrition type specific helper functions
+def is_whole_day(time):
+    return time is None or time.time() == datetime.time()
+
+
+def rollup_query(handle, bucket, time_from, time_to):
+    # daily rollup rows summed up per bucket, only valid for whole day ranges
+    bucket_expr = func.strftime(NUTRITION_BUCKETS[bucket], NutritionRollup.day).label('bucket')
+    query = NutritionRollup.query.with_entities(
+        bucket_expr, *[func.sum(getattr(NutritionRollup, n)).label(n) for n in NUTRIENTS]) \
+        .filter(NutritionRollup.person_key == key_of(Person, handle))
+    if time_from is not None:
+        query = query.filter(NutritionRollup.day >= time_from.date())
+    if time_to is not None:
+        query = query.filter(NutritionRollup.day < time_to.date())
+    return query.group_by(bucket_expr).order_by(bucket_expr)
+
+
+def mealrecord_query(handle, bucket, time_from, time_to):
+    # aggregate straight from the meal records, for ranges that split a day
+    bucket_expr = epoch_strftime(NUTRITION_BUCKETS[bucket], MealRecord.timestamp).label('bucket')
+    query = MealRecord.query.with_entities(bucket_expr, *nutrient_sums()) \
+        .join(MealPortion, MealPortion.meal_key == MealRecord.meal_key) \
+        .join(Portion, Portion.key == MealPortion.portion_key) \
+        .filter(MealRecord.person_key == key_of(Person, handle))
+    if time_from is not None:
+        query = query.filter(MealRecord.timestamp >= time_from)
+    if time_to is not None:
+        query = query.filter(MealRecord.timestamp < time_to)
+    return query.group_by(bucket_expr).order_by(bucket_expr)
+
+
+def add_control_nutrition(resp, handle):
+    resp.add_control(NS + ':nutrition', "{}{}{}/nutrition/".format(
+        ROUTE_ENTRYPOINT,
+        ROUTE_PERSON_COLLECTION,
+        handle))
+
+
+class NutritionItem(Resource):
+    """ NutritionItem serves the calories and macros eaten by a person, summed up per time bucket.
+    The sums are read from the daily NutritionRollup, or calculated in one SQL aggregate over
+    MealRecords, MealPortions and Portions if the time range does not consist of whole days.
+    Query parameters: 'from' (inclusive) and 'to' (exclusive) limit the time range and
+    'bucket' is one of day (default), week, month or year. """
+    @classmethod
+    @conditional_get(Person, MealRecord, MealPortion, Portion, NutritionRollup)
+    def get(cls, handle):
+        try:
+            time_from = parse_time_arg('from')
+            time_to = parse_time_arg('to')
+        except ValueError:
+            return error_400_query()
+        bucket = request.args.get('bucket', 'day')
+        if bucket not in NUTRITION_BUCKETS:
+            return error_400_query()
+
+        person = Person.query.filter(Person.id == handle).first()
+        if person is None:
+            return error_404()
+
+        if is_whole_day(time_from) and is_whole_day(time_to):
+            query = rollup_query(handle, bucket, time_from, time_to)
+        else:
+            query = mealrecord_query(handle, bucket, time_from, time_to)
+
+        resp = CalorieBuilder(person_id=handle, bucket=bucket, items=[])
+        for row in query:
+            item = {'bucket': row.bucket}
+            for n in NUTRIENTS:
+                item[n] = getattr(row, n)
+            resp['items'].append(item)
+
+        resp.add_control_self(api.url_for(NutritionItem, handle=handle))
+        resp.add_control(NS + ':mealrecords-by', "{}{}{}/mealrecords/".format(
+            ROUTE_ENTRYPOINT,
+            ROUTE_PERSON_COLLECTION,
+            handle))
+        add_calorie_namespace(resp)
+        return mason_response(resp)
@@ -1,17 +1,18 @@
-import json
-
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import SchemaError, ValidationError
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import Person
+from tapi.models import Person, ActivityRecord, MealRecord, NutritionRollup, key_of
+from tapi.resources.nutrition import add_control_nutrition
 from tapi.utils import add_mason_response_header, add_calorie_namespace, person_to_api_person
-from tapi.utils import CalorieBuilder
-from tapi.utils import error_400, error_404, error_409, error_415
+from tapi.utils import CalorieBuilder, ControlTemplate, KeysetPage, collection_response, mason_response
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_415
 from tapi.constants import MASON, NS, ROUTE_ENTRYPOINT, ROUTE_PERSON_COLLECTION
 from tapi import db
+from tapi.versions import conditional_get, bump_versions
+from tapi.validators import register_validator
 from tapi.api import api
 
 
@@ -31,14 +32,17 @@ def person_schema():
     return schema
 
 
+PERSON_VALIDATOR = register_validator("person", person_schema())
+
+
 def add_control_add_person(resp):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":add-person",
         href=api.url_for(PersonItem, handle=None),
         method="POST",
         encoding="json",
         title="Creates a new Person",
-        schema=person_schema()
+        schema_name="person"
     )
 
 
@@ -49,19 +53,49 @@ def add_control_mealrecords(resp, handle):
         handle))
 
 
+def person_item_controls():
+    # controls of the items of the Person collection
+    p = CalorieBuilder()
+    p.add_control_collection(api.url_for(PersonItem, handle=None))
+    return ControlTemplate(p)
+
+
+def person_collection_item(person, controls):
+    return controls.add_to(person_to_api_person(person))
+
+
+def delete_person(person_id):
+    """ Deletes the Person with its MealRecords, ActivityRecords and NutritionRollup rows, each
+    table with one DELETE, instead of loading every child row through the cascades of the
+    relationships. Core deletes skip the flush hooks, so the versions are updated here. """
+    connection = db.session.connection()
+    person_key = key_of(Person, person_id)
+    deletes = [
+        (MealRecord.__table__, MealRecord.person_key == person_key),
+        (ActivityRecord.__table__, ActivityRecord.person_id == person_id),
+        # the rollup rows of the person are derived from its MealRecords only
+        (NutritionRollup.__table__, NutritionRollup.person_key == person_key),
+        (Person.__table__, Person.id == person_id)
+    ]
+    tables = [table.name for table, where in deletes if connection.execute(table.delete().where(where)).rowcount]
+    bump_versions(connection, tables)
+    db.session.commit()
+
+
 class PersonItem(Resource):
     """ PersonItem servers both: Individual PersonItem and Person Collection
     If given handle is missing, the Person Collection is returned. If handle is
     given, the corresponding PersonItem is returned (if found from the DB) """
     @classmethod
+    @conditional_get(Person)
     def get(cls, handle=None):
         if handle is None:
             # Person collection
+            try:
+                page = KeysetPage(Person.query, [Person.id])
+            except ValueError:
+                return error_400_query()
             resp = CalorieBuilder(items=[])
-            for person in Person.query.all():
-                p = person_to_api_person(person)
-                p.add_control_collection(api.url_for(PersonItem, handle=None))
-                resp['items'].append(p)
             add_control_add_person(resp)
         else:
             # Person item
@@ -72,12 +106,17 @@ class PersonItem(Resource):
             resp.add_control_collection(api.url_for(PersonItem, handle=None))
             resp.add_control_delete(api.url_for(PersonItem, handle=handle))
             add_control_mealrecords(resp, handle)
+            add_control_nutrition(resp, handle)
 
         # Common fields for person item and person collection
         resp.add_control_self(api.url_for(PersonItem, handle=handle))
         resp.add_control(NS+':persons-all', api.url_for(PersonItem, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        if handle is None:
+            controls = person_item_controls()
+            return collection_response(resp, page, lambda person: person_collection_item(person, controls),
+                                       api.url_for(PersonItem, handle=None), person_to_api_person)
+        return mason_response(resp)
 
     @classmethod
     def post(cls):
@@ -88,7 +127,7 @@ class PersonItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=person_schema())
+            PERSON_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
@@ -114,6 +153,5 @@ class PersonItem(Resource):
         person = Person.query.filter(Person.id == handle).first()
         if person is None:
             return error_404()
-        db.session.delete(person)
-        db.session.commit()
+        delete_person(handle)
         return Response("DELETED", 204, mimetype=MASON)
@@ -1,17 +1,20 @@
-import json
-
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import SchemaError, ValidationError
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import Portion
+from tapi.models import MealPortion, NutritionRollup, Portion
 from tapi.utils import add_mason_response_header, add_calorie_namespace, portion_to_api_portion
-from tapi.utils import CalorieBuilder
-from tapi.utils import error_400, error_404, error_409, error_415
+from tapi.utils import CalorieBuilder, ControlTemplate, KeysetPage, collection_response, mason_response, url_template
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_415
 from tapi.constants import MASON, NS
 from tapi import db
+from tapi.versions import conditional_get, bump_versions
+from tapi.rollup import meal_days, refresh_rollup
+from tapi.catalogue import catalogue_row, invalidate_catalogue
+from tapi.validators import register_validator
 from tapi.api import api
 
 
@@ -65,27 +68,30 @@ def portion_schema():
     return schema
 
 
+PORTION_VALIDATOR = register_validator("portion", portion_schema())
+
+
 def add_control_add_portion(resp):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":add-portion",
         href=api.url_for(PortionItem, handle=None),
         method="POST",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Creates a new Portion",
-        schema=portion_schema()
+        schema_name="portion"
     )
 
 
 def add_control_edit_portion(resp, handle):
-    resp.add_control(
+    resp.add_control_with_schema(
         NS + ":edit-portion",
         href=api.url_for(PortionItem) + handle + '/',
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a Portion",
-        schema=portion_schema()
+        schema_name="portion"
     )
 
 
@@ -98,24 +104,57 @@ def extract_optional_fields(json_data):
     return fields
 
 
+def portion_item_controls():
+    # controls of the items of the Portion collection
+    m = CalorieBuilder()
+    m.add_control_collection(api.url_for(PortionItem, handle=None))
+    m.add_control_delete(url_template(PortionItem, 'handle'))
+    return ControlTemplate(m)
+
+
+def portion_collection_item(portion, controls):
+    return controls.add_to(portion_to_api_portion(portion), handle=portion.id)
+
+
+def delete_portion(portion_id):
+    """ Deletes the Portion with its MealPortions, which the foreign keys don't do as they are
+    not enforced, and recalculates the rollup of the days the meals of the Portion were eaten.
+    Core deletes skip the flush hooks, so the rollup and the versions are updated here. """
+    connection = db.session.connection()
+    portion_key = connection.execute(select([Portion.key]).where(Portion.id == portion_id)).scalar()
+    meal_keys = [key for key, in connection.execute(
+        select([MealPortion.meal_key]).where(MealPortion.portion_key == portion_key))]
+    keys = meal_days(connection, meal_keys) if meal_keys else set()
+    deletes = [
+        (MealPortion.__table__, MealPortion.portion_key == portion_key),
+        (Portion.__table__, Portion.key == portion_key)
+    ]
+    tables = [table.name for table, where in deletes if connection.execute(table.delete().where(where)).rowcount]
+    refresh_rollup(connection, keys)
+    if keys:
+        tables.append(NutritionRollup.__tablename__)
+    bump_versions(connection, tables)
+    db.session.commit()
+
+
 class PortionItem(Resource):
     """ PortionItem servers both: Individual PortionItem and Portion Collection
     If given handle is missing, the Portion Collection is returned. If handle is
     given, the corresponding PortionItem is returned (if found from the DB) """
     @classmethod
+    @conditional_get(Portion)
     def get(cls, handle=None):
         if handle is None:
             # Portion collection
+            try:
+                page = KeysetPage(Portion.query, [Portion.id])
+            except ValueError:
+                return error_400_query()
             resp = CalorieBuilder(items=[])
-            for portion in Portion.query.all():
-                m = portion_to_api_portion(portion)
-                m.add_control_collection(api.url_for(PortionItem, handle=None))
-                m.add_control_delete(api.url_for(PortionItem, handle=portion.id))
-                resp['items'].append(m)
             add_control_add_portion(resp)
         else:
             # Portion item
-            portion = Portion.query.filter(Portion.id == handle).first()
+            portion = catalogue_row(Portion, handle)
             if portion is None:
                 return error_404()
 
@@ -129,7 +168,11 @@ class PortionItem(Resource):
         resp.add_control_self(api.url_for(PortionItem, handle=handle))
         resp.add_control(NS+':portions-all', api.url_for(PortionItem, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        if handle is None:
+            controls = portion_item_controls()
+            return collection_response(resp, page, lambda portion: portion_collection_item(portion, controls),
+                                       api.url_for(PortionItem, handle=None), portion_to_api_portion)
+        return mason_response(resp)
 
     @classmethod
     def post(cls):
@@ -140,7 +183,7 @@ class PortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=portion_schema())
+            PORTION_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
@@ -165,6 +208,7 @@ class PortionItem(Resource):
         except IntegrityError:
             db.session.rollback()
             return error_409()
+        invalidate_catalogue(Portion)
 
         h = add_mason_response_header()
         h.add('Location', api.url_for(PortionItem, handle=portion.id))
@@ -183,7 +227,7 @@ class PortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=portion_schema())
+            PORTION_VALIDATOR.validate(request.json)
         except (SchemaError, ValidationError):
             return error_400()
 
@@ -205,6 +249,7 @@ class PortionItem(Resource):
         except IntegrityError:
             db.session.rollback()
             return error_409()
+        invalidate_catalogue(Portion)
 
         return Response(
             response="",
@@ -217,6 +262,6 @@ class PortionItem(Resource):
         portion = Portion.query.filter(Portion.id == handle).first()
         if portion is None:
             return error_404()
-        db.session.delete(portion)
-        db.session.commit()
+        delete_portion(handle)
+        invalidate_catalogue(Portion)
         return Response("DELETED", 204, mimetype=MASON)
@@ -0,0 +1,113 @@
+""" Incremental maintenance of the per-person daily NutritionRollup.
+
+Every flush that touches MealRecords, MealPortions or the nutrients of a Portion
+recalculates the rollup rows of the affected (person, day) keys from the raw tables.
+Changes to MealPortions and Portions fan out to every day the affected meals were eaten.
+"""
+import datetime
+import itertools
+
+from sqlalchemy import bindparam, event, func, inspect, select
+
+from tapi import db
+from tapi.constants import NUTRIENTS
+from tapi.models import MealRecord, MealPortion, Portion, NutritionRollup, epoch_date
+from tapi.versions import bump_versions
+
+
+def nutrient_sums():
+    # nutrients per 100g of portion, weighted by grams per serving and servings eaten
+    return [func.sum(MealRecord.amount * MealPortion.weight_per_serving *
+                     func.coalesce(getattr(Portion, n), 0) / 100).label(n)
+            for n in NUTRIENTS]
+
+
+def rollup_select():
+    # daily sums of all meal records, the same aggregate the rollup table stores
+    day = epoch_date(MealRecord.timestamp)
+    return select([MealRecord.person_key, day] + nutrient_sums()) \
+        .select_from(MealRecord.__table__
+                     .join(MealPortion.__table__, MealPortion.meal_key == MealRecord.meal_key)
+                     .join(Portion.__table__, Portion.key == MealPortion.portion_key)) \
+        .group_by(MealRecord.person_key, day)
+
+
+def refresh_rollup(connection, keys):
+    """ Recalculates the rollup rows of the given (person_key, day) keys """
+    if not keys:
+        return
+    table = NutritionRollup.__table__
+    columns = [table.c.person_key, table.c.day] + [table.c[n] for n in NUTRIENTS]
+    # both statements are compiled once and run for all the keys with executemany
+    params = []
+    for person_key, day in keys:
+        start = datetime.datetime.combine(day, datetime.time())
+        params.append({'key_person': person_key, 'key_day': day,
+                       'key_start': start, 'key_end': start + datetime.timedelta(days=1)})
+    connection.execute(table.delete().where(table.c.person_key == bindparam('key_person'))
+                       .where(table.c.day == bindparam('key_day')), params)
+    connection.execute(table.insert().from_select(
+        columns,
+        rollup_select().where(MealRecord.person_key == bindparam('key_person'))
+                       .where(MealRecord.timestamp >= bindparam('key_start'))
+                       .where(MealRecord.timestamp < bindparam('key_end'))), params)
+
+
+def meal_days(connection, meal_keys):
+    """ Returns the (person_key, day) keys of the days the meals of the given keys were eaten """
+    return {(person_key, datetime.date.fromisoformat(day)) for person_key, day in connection.execute(
+        select([MealRecord.person_key, epoch_date(MealRecord.timestamp)])
+        .where(MealRecord.meal_key.in_(meal_keys)).distinct())}
+
+
+def rebuild_rollup():
+    """ Repairs the whole rollup table from the raw tables """
+    table = NutritionRollup.__table__
+    columns = [table.c.person_key, table.c.day] + [table.c[n] for n in NUTRIENTS]
+    connection = db.session.connection()
+    connection.execute(table.delete())
+    connection.execute(table.insert().from_select(columns, rollup_select()))
+    bump_versions(connection, [table.name])
+    db.session.commit()
+
+
+def history_values(obj, attr):
+    # current value of the attribute and the value it had before this flush
+    history = inspect(obj).attrs[attr].history
+    return set(history.deleted) | {getattr(obj, attr)}
+
+
+def mealrecord_keys(obj):
+    for person_key in history_values(obj, 'person_key'):
+        for timestamp in history_values(obj, 'timestamp'):
+            if person_key is not None and timestamp is not None:
+                yield person_key, timestamp.date()
+
+
+def nutrients_changed(obj):
+    return any(inspect(obj).attrs[n].history.has_changes() for n in NUTRIENTS)
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_rollup(session, flush_context):
+    keys = set()
+    meal_keys = set()
+    portion_keys = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, MealRecord):
+            keys.update(mealrecord_keys(obj))
+        elif isinstance(obj, MealPortion):
+            meal_keys.update(history_values(obj, 'meal_key'))
+        elif isinstance(obj, Portion) and obj not in session.new:
+            if obj in session.deleted or nutrients_changed(obj):
+                portion_keys.add(obj.key)
+    if not (keys or meal_keys or portion_keys):
+        return
+
+    connection = session.connection()
+    if portion_keys:
+        meal_keys.update(r[0] for r in connection.execute(
+            select([MealPortion.meal_key]).where(MealPortion.portion_key.in_(portion_keys))))
+    if meal_keys:
+        keys.update(meal_days(connection, meal_keys))
+    refresh_rollup(connection, keys)
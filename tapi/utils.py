@@ -1,9 +1,25 @@
+import re
 import json
+import base64
 import datetime
+from urllib.parse import urlencode, quote
 
+from sqlalchemy import literal, tuple_
 from werkzeug.datastructures import Headers
 from tapi.constants import *
-from flask import request, Response
+from tapi.validators import VALIDATORS
+from flask import request, Request, Response, current_app, stream_with_context
+from werkzeug.exceptions import BadRequest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 # MasonBuilder was given during the exercises. Here with no modifications.
@@ -135,6 +151,91 @@ def myconverter(o):
         return o.__str__()
 
 
+def stdlib_encode_json(obj):
+    return json.dumps(obj, default=myconverter)
+
+
+def orjson_encode_json(obj):
+    # orjson writes datetimes in ISO format, they are passed to myconverter to keep the format of the API
+    return orjson.dumps(obj, default=myconverter, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+
+
+# JSON encoders by name, chosen with JSON_ENCODER in the app config
+JSON_ENCODERS = {'json': stdlib_encode_json}
+if orjson is not None:
+    JSON_ENCODERS['orjson'] = orjson_encode_json
+
+
+def register_json_encoder(name, encode):
+    """ Adds an encoder that can be chosen with JSON_ENCODER. encode(obj) must return the
+    JSON document as str, with the datetimes converted like myconverter does """
+    JSON_ENCODERS[name] = encode
+
+
+def encode_json(obj):
+    """ Serializes obj with the JSON_ENCODER of the app config. The default 'auto' is orjson
+    if it's installed and the standard library json otherwise """
+    name = current_app.config["JSON_ENCODER"]
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    return JSON_ENCODERS[name](obj)
+
+
+def msgpack_encode(obj):
+    # datetimes as in the JSON documents
+    return msgpack.packb(obj, default=myconverter)
+
+
+def msgpack_decode(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+# Binary encodings of the same documents as the JSON ones, as (encode, decode) by media type.
+# The client chooses them with Accept for the responses and with Content-Type for the request bodies.
+BINARY_CODECS = {}
+if msgpack is not None:
+    BINARY_CODECS[MSGPACK] = (msgpack_encode, msgpack_decode)
+
+
+class CalorieRequest(Request):
+    """ Request whose json is also the decoded body of the BINARY_CODECS media types """
+    def get_json(self, force=False, silent=False, cache=True):
+        codec = BINARY_CODECS.get(self.mimetype)
+        if codec is None:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        if cache and getattr(self, '_binary_json', None) is not None:
+            return self._binary_json
+        try:
+            rv = codec[1](self.get_data(cache=cache))
+        except Exception:
+            if silent:
+                return None
+            raise BadRequest("Failed to decode the request body")
+        if cache:
+            self._binary_json = rv
+        return rv
+
+
+def response_media_type(json_type=MASON):
+    """ json_type, or the binary encoding of it if the client prefers that in Accept """
+    return request.accept_mimetypes.best_match([json_type] + list(BINARY_CODECS), default=json_type)
+
+
+def encode_body(obj, media_type):
+    if media_type in BINARY_CODECS:
+        return BINARY_CODECS[media_type][0](obj)
+    return encode_json(obj)
+
+
+def mason_response(body, status=200):
+    """ Response of a Mason document in the encoding negotiated with the Accept header """
+    media_type = response_media_type()
+    headers = Headers()
+    headers.add('Content-Type', media_type)
+    headers.add('Vary', 'Accept')
+    return Response(encode_body(body, media_type), status, headers=headers)
+
+
 def make_mealportion_handle(meal, portion):
     return "{}-{}".format(meal, portion)
 
@@ -142,10 +243,23 @@ def make_mealportion_handle(meal, portion):
 def make_mealrecord_handle(person, meal, timestamp):
     # parse parameters to make unique handle
     handle = person + '-' + meal + '-' + \
-             datetime.datetime.strftime(timestamp, '%Y-%m-%d %H:%M:%S.%f').replace(" ", "_")
+             datetime.datetime.strftime(timestamp, TIMESTAMP_FORMAT).replace(" ", "_")
     return handle
 
 
+# TIMESTAMP_FORMAT with the full six digit microseconds that the API writes, digits only
+FULL_TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{6}', re.ASCII)
+
+
+def parse_timestamp(value):
+    """ Parses a naive timestamp of TIMESTAMP_FORMAT, raises ValueError if it's not valid.
+    fromisoformat is many times faster than strptime but accepts other ISO layouts too, e.g.
+    with a time zone, so it only parses the FULL_TIMESTAMP layout and strptime the rest. """
+    if FULL_TIMESTAMP.fullmatch(value):
+        return datetime.datetime.fromisoformat(value)
+    return datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
 class CalorieBuilder(MasonBuilder):
     """ CalorieBuilder is a neat utility class for building the MASON response """
     def add_control_profile(self):
@@ -170,6 +284,29 @@ class CalorieBuilder(MasonBuilder):
             href=href
         )
 
+    def add_control_with_schema(self, ctrl_name, href, schema_name, **kwargs):
+        # the schema is embedded in the control, or with SCHEMA_URLS only referenced
+        # with schemaUrl so that it's not repeated for every item of a collection
+        if current_app.config["SCHEMA_URLS"]:
+            kwargs["schemaUrl"] = ROUTE_ENTRYPOINT + ROUTE_SCHEMA_COLLECTION + schema_name + '/'
+        else:
+            kwargs["schema"] = VALIDATORS[schema_name].schema
+        self.add_control(ctrl_name, href, **kwargs)
+
+    def add_control_next(self, href):
+        # next is IANA defined control, outside of calorie namespace
+        self.add_control(
+            "next",
+            href=href
+        )
+
+    def add_control_prev(self, href):
+        # prev is IANA defined control, outside of calorie namespace
+        self.add_control(
+            "prev",
+            href=href
+        )
+
     def add_control_delete(self, href):
         # delete is calmeta specific control, within calorie namespace
         self.add_control(
@@ -179,6 +316,264 @@ class CalorieBuilder(MasonBuilder):
         )
 
 
+def url_template(resource, *names):
+    """ Returns api.url_for(resource) with {name} placeholders for the given URL variables,
+    to be filled in with ControlTemplate. Werkzeug URL building is slow compared to formatting
+    a string, so the template is built once per app. """
+    cache = current_app.extensions.setdefault('tapi_url_templates', {})
+    key = (resource, names, request.script_root)
+    template = cache.get(key)
+    if template is None:
+        from tapi.api import api
+        template = api.url_for(resource, **{name: '{' + name + '}' for name in names})
+        for name in names:
+            template = template.replace(quote('{' + name + '}'), '{' + name + '}')
+        cache[key] = template
+    return template
+
+
+class ControlTemplate:
+    """ The @controls of the items of a collection, built once per response with the usual
+    CalorieBuilder methods and {name} placeholders, e.g. from url_template, in the hrefs.
+    The controls without placeholders are the same for every item and shared by the items,
+    so they must not be modified. """
+    def __init__(self, builder):
+        self.controls = [(name, ctrl, '{' in ctrl['href']) for name, ctrl in builder['@controls'].items()]
+
+    def add_to(self, item, **values):
+        """ Adds the controls to the item, the placeholders replaced by the URL quoted values """
+        # quoted the same way as the Werkzeug URL converters do
+        quoted = {k: quote(v, safe='/:') for k, v in values.items()}
+        item['@controls'] = {name: dict(ctrl, href=ctrl['href'].format(**quoted)) if templated else ctrl
+                             for name, ctrl, templated in self.controls}
+        return item
+
+
+def encode_cursor(columns, row):
+    # opaque pagination cursor made of the key column values of the row
+    values = []
+    for c in columns:
+        value = getattr(row, c.key)
+        if isinstance(value, datetime.datetime):
+            value = datetime.datetime.strftime(value, TIMESTAMP_FORMAT)
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(columns, cursor):
+    # reverse of encode_cursor, raises ValueError if the cursor is not valid
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError("Cursor does not match the key columns")
+    for i, c in enumerate(columns):
+        python_type = c.type.python_type
+        # the datetimes are encoded as timestamp strings, bool is an int too but not in a cursor
+        expected = str if python_type is datetime.datetime else python_type
+        if not isinstance(values[i], expected) or isinstance(values[i], bool):
+            raise ValueError("Cursor value does not match the type of the key column")
+        if python_type is datetime.datetime:
+            values[i] = parse_timestamp(values[i])
+    return values
+
+
+def cursor_tuple(columns, cursor):
+    # the cursor values bound with the types of the columns, a tuple doesn't pass them on
+    return tuple_(*[literal(value, c.type) for c, value in zip(columns, decode_cursor(columns, cursor))])
+
+
+def page_size():
+    # requested page size, defaults to and is capped by the app config
+    limit = int(request.args.get('limit', current_app.config["PAGE_SIZE"]))
+    if limit < 1:
+        raise ValueError("Invalid page size")
+    return min(limit, current_app.config["MAX_PAGE_SIZE"])
+
+
+def parse_time_arg(name):
+    # time query parameter, given as a date or as a full mealrecord timestamp, None if missing.
+    # Raises ValueError if the value is not valid.
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return parse_timestamp(value)
+
+
+def page_order():
+    # True if the client asked for the descending order, 'order' is 'asc' (default) or 'desc'
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("Invalid order")
+    return order == 'desc'
+
+
+class KeysetPage:
+    """ One page of the query ordered by the given unique key columns.
+    The page is chosen with the 'after' or 'before' cursor and the 'limit' request arguments,
+    and the 'order' argument reverses the order of the whole collection, so every page costs
+    one index range scan no matter how big the table is.
+    Iterating the page fetches the rows lazily in batches. The cursors of the previous and
+    next pages (None if there is no page) are known once the page has been iterated.
+    Raises ValueError if the request arguments are not valid. """
+    def __init__(self, query, columns):
+        self.columns = columns
+        self.limit = page_size()
+        self.after = request.args.get('after')
+        self.before = request.args.get('before')
+        descending = page_order()
+        key = tuple_(*columns)
+        if self.before is not None:
+            cursor = cursor_tuple(columns, self.before)
+            query = query.filter(key > cursor if descending else key < cursor)
+            query = query.order_by(*[c if descending else c.desc() for c in columns])
+        else:
+            if self.after is not None:
+                cursor = cursor_tuple(columns, self.after)
+                query = query.filter(key < cursor if descending else key > cursor)
+            query = query.order_by(*[c.desc() if descending else c for c in columns])
+        self.query = query.limit(self.limit + 1).yield_per(STREAM_BATCH_SIZE)
+        self.prev_cursor = None
+        self.next_cursor = None
+
+    def __iter__(self):
+        if self.before is not None:
+            # rows come in the reverse order, a page is at most limit rows to reverse
+            rows = self.query.all()
+            has_more = len(rows) > self.limit
+            rows = rows[:self.limit][::-1]
+            if rows:
+                self.prev_cursor = encode_cursor(self.columns, rows[0]) if has_more else None
+                self.next_cursor = encode_cursor(self.columns, rows[-1])
+            yield from rows
+            return
+
+        first = last = None
+        count = 0
+        for row in self.query:
+            if count == self.limit:
+                self.next_cursor = encode_cursor(self.columns, last)
+                break
+            if first is None:
+                first = row
+            last = row
+            count += 1
+            yield row
+        if first is not None and self.after is not None:
+            self.prev_cursor = encode_cursor(self.columns, first)
+
+
+def page_links(href, page):
+    # prev/next URLs of the KeysetPage, they keep the page size, the filters, the view and
+    # the other query parameters the client asked for
+    args = {k: v for k, v in request.args.items() if k not in ('after', 'before')}
+    links = {}
+    if page.prev_cursor is not None:
+        links['prev'] = href + '?' + urlencode(dict(args, before=page.prev_cursor))
+    if page.next_cursor is not None:
+        links['next'] = href + '?' + urlencode(dict(args, after=page.next_cursor))
+    return links
+
+
+def add_pagination_controls(resp, href, page):
+    links = page_links(href, page)
+    if 'prev' in links:
+        resp.add_control_prev(links['prev'])
+    if 'next' in links:
+        resp.add_control_next(links['next'])
+
+
+def requested_view():
+    """ Name of the COLLECTION_VIEWS representation that the client asked for with the 'view'
+    query parameter or with the Accept header, Mason by default.
+    Raises ValueError if the view parameter is not valid. """
+    view = request.args.get('view')
+    if view is None:
+        media_type = request.accept_mimetypes.best_match(list(COLLECTION_VIEWS.values()), default=MASON)
+        return next(name for name, t in COLLECTION_VIEWS.items() if t == media_type)
+    if view not in COLLECTION_VIEWS:
+        raise ValueError("Unknown view")
+    return view
+
+
+def requested_expansions(allowed):
+    """ Names of the related resources to embed that the client asked for with the comma
+    separated 'expand' query parameter. A nested name expands its parents too, e.g.
+    'portions.portion' gives {'portions', 'portions.portion'}.
+    Raises ValueError if a name is not in allowed. """
+    expand = set()
+    for name in request.args.get('expand', '').split(','):
+        if not name:
+            continue
+        if name not in allowed:
+            raise ValueError("Unknown expansion")
+        parts = name.split('.')
+        expand.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return expand
+
+
+def collection_response(resp, page, build_item, href, build_row=None):
+    """ Response of a collection: resp is the envelope with all but the item specific content,
+    build_item builds the API item of a row of the KeysetPage and href is the collection URL.
+    build_row builds the data of a row without the hypermedia for the compact views, see
+    COLLECTION_VIEWS: 'compact' is the list of the rows and 'columns' the column names and
+    the rows as lists of values, both with the prev/next URLs.
+    With STREAM_COLLECTIONS the items are serialized one at a time while the rows are fetched,
+    so the memory use doesn't depend on the page size and the first bytes go out right away. """
+    try:
+        view = requested_view() if build_row is not None else 'mason'
+    except ValueError:
+        return error_400_query()
+    media_type = response_media_type(COLLECTION_VIEWS[view])
+    headers = Headers()
+    headers.add('Content-Type', media_type)
+    headers.add('Vary', 'Accept')
+
+    columns = []
+    if view == 'mason':
+        items_key, build = 'items', build_item
+    elif view == 'compact':
+        items_key, build = 'items', build_row
+    else:
+        items_key = 'rows'
+
+        def build(row):
+            item = build_row(row)
+            if not columns:
+                columns.extend(item)
+            return list(item.values())
+
+    def envelope():
+        # everything but the items, the pagination is known only after the last row
+        if view == 'mason':
+            add_pagination_controls(resp, href, page)
+            return {k: v for k, v in resp.items() if k != 'items'}
+        doc = {'columns': columns} if view == 'columns' else {}
+        doc.update(page_links(href, page))
+        return doc
+
+    # the binary encodings need the length of the items up front, so they're not streamed
+    if not current_app.config["STREAM_COLLECTIONS"] or media_type in BINARY_CODECS:
+        items = [build(row) for row in page]
+        if view == 'mason':
+            resp['items'] = items
+            add_pagination_controls(resp, href, page)
+            return Response(encode_body(resp, media_type), 200, headers=headers)
+        doc = {items_key: items}
+        doc.update(envelope())
+        return Response(encode_body(doc, media_type), 200, headers=headers)
+
+    def generate():
+        yield '{"' + items_key + '": ['
+        for i, row in enumerate(page):
+            yield (', ' if i else '') + encode_json(build(row))
+        rest = envelope()
+        yield '], ' + encode_json(rest)[1:] if rest else ']}'
+
+    return Response(stream_with_context(generate()), 200, headers=headers)
+
+
 def add_calorie_namespace(resp):
     resp.add_namespace(NS, URL_LINK_RELATIONS)
 
@@ -197,7 +592,7 @@ def create_error_response(status_code, title, message=None):
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return mason_response(body, status_code)
 
 
 def error_404():
@@ -218,3 +613,13 @@ def error_409():
 def error_400():
     return create_error_response(
         400, "Invalid JSON", "Request JSON does not follow the jsonschema.")
+
+
+def error_413():
+    return create_error_response(
+        413, "Too many items", "Request has more items than allowed in one request.")
+
+
+def error_400_query():
+    return create_error_response(
+        400, "Invalid query", "Request query parameters are not valid.")
@@ -0,0 +1,49 @@
+""" Registry of the request body validators.
+
+Every schema is checked and its validator built once at import, instead of on every
+POST/PUT. If fastjsonschema is installed and FAST_VALIDATION is enabled in the app config,
+a code generated validator is used instead. Code generation is slow, so it's compiled
+on first use to keep the startup fast.
+"""
+from flask import current_app
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# jsonschema does not assert "format" without a format checker, keep fastjsonschema in line
+IGNORED_FORMATS = {'date-time': lambda value: True}
+
+VALIDATORS = {}
+
+
+class SchemaValidator:
+    """ Validator of one schema, validate() raises jsonschema.ValidationError on invalid input """
+    def __init__(self, schema):
+        self.schema = schema
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        self.validator = cls(schema)
+        self.fast_validator = None
+
+    def compile_fast_validator(self):
+        if self.fast_validator is None:
+            self.fast_validator = fastjsonschema.compile(self.schema, formats=IGNORED_FORMATS)
+        return self.fast_validator
+
+    def validate(self, instance):
+        if fastjsonschema is not None and current_app.config.get("FAST_VALIDATION"):
+            try:
+                self.compile_fast_validator()(instance)
+            except fastjsonschema.JsonSchemaException as e:
+                raise ValidationError(e.message)
+        else:
+            self.validator.validate(instance)
+
+
+def register_validator(name, schema):
+    VALIDATORS[name] = SchemaValidator(schema)
+    return VALIDATORS[name]
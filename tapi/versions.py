@@ -0,0 +1,88 @@
+""" Per-table version counters and conditional GET support.
+
+Every flush bumps the TableVersion of the tables it writes to. The ETag of a resource
+is derived from the versions of the tables its representation is built from, so a
+conditional GET costs one version lookup instead of building the whole document.
+"""
+import hashlib
+import itertools
+from functools import wraps
+
+from flask import request, Response
+from sqlalchemy import event, select
+
+from tapi import db
+from tapi.models import TableVersion
+from tapi.compression import cached_response
+from tapi.utils import requested_expansions
+
+
+def bump_versions(connection, tables):
+    """ Increments the version counters of the given table names """
+    table = TableVersion.__table__
+    for name in tables:
+        result = connection.execute(table.update().where(table.c.name == name)
+                                    .values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(name=name, version=1))
+
+
+def table_versions(tables):
+    """ Returns {table name: version} of the given table names, 0 for never written tables """
+    table = TableVersion.__table__
+    versions = dict.fromkeys(tables, 0)
+    versions.update(db.session.execute(
+        select([table.c.name, table.c.version]).where(table.c.name.in_(tables))).fetchall())
+    return versions
+
+
+def resource_etag(tables):
+    # same URL, Accept header and table versions always give the same representation
+    versions = table_versions(tables)
+    key = request.full_path + '|' + request.headers.get('Accept', '') + '|' + ','.join('{}={}'.format(t, versions[t]) for t in sorted(versions))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def expanded_tables(tables, expansions):
+    # the tables of the request, with the tables of the related resources it embeds
+    try:
+        expand = requested_expansions(expansions)
+    except ValueError:
+        # the handler answers 400
+        return tables
+    return sorted(set(tables).union(m.__tablename__ for name in expand for m in expansions[name]))
+
+
+def conditional_get(*models, expansions=None):
+    """ Decorator for GET handlers that adds a strong ETag to 200 responses and answers
+    304 Not Modified, without calling the handler, if the client already has the representation.
+    If the compressed body of the ETag is cached, it's served without calling the handler either.
+    The models are the ones the representation is built from, expansions maps the ?expand=
+    names of the resource to the models of the related resources that they embed. """
+    tables = [m.__tablename__ for m in models]
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            etag = resource_etag(expanded_tables(tables, expansions) if expansions else tables)
+            # the compressed responses have the weak version of the ETag
+            if request.if_none_match.contains_weak(etag):
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                return resp
+            resp = cached_response(etag)
+            if resp is None:
+                resp = func(*args, **kwargs)
+                if resp.status_code == 200:
+                    resp.set_etag(etag)
+            return resp
+        return wrapper
+    return decorator
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_versions(session, flush_context):
+    tables = {obj.__tablename__ for obj in itertools.chain(session.new, session.dirty, session.deleted)
+              if session.is_modified(obj) or obj not in session.dirty}
+    if tables:
+        bump_versions(session.connection(), sorted(tables))
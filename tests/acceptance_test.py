@@ -27,7 +27,8 @@ def app():
     app = create_app(config)
 
     with app.app_context():
-        db.reflect()
+        # sqlite_sequence of the AUTOINCREMENT keys belongs to SQLite, it can't be dropped
+        db.metadata.reflect(db.engine, only=lambda name, meta: not name.startswith("sqlite_"))
         db.drop_all()
         db.create_all()
 
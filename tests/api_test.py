@@ -1,14 +1,17 @@
 import json
+import base64
 import datetime
 import pytest
 from tapi import db, create_app
 from tapi.constants import *
-from tapi.models import Person, Meal, MealRecord, MealPortion, Portion
+from tapi.models import Person, Meal, MealRecord, MealPortion, Portion, Activity, ActivityRecord, NutritionRollup
 # BEGIN Original fixture setup taken from the Exercise example and then modified further
 from tapi.utils import make_mealrecord_handle, myconverter, make_mealportion_handle
+from tapi.versions import bump_versions
 
 import os
 import tempfile
+from contextlib import contextmanager
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
@@ -27,7 +30,8 @@ def app():
     app = create_app(config)
 
     with app.app_context():
-        db.reflect()
+        # sqlite_sequence of the AUTOINCREMENT keys belongs to SQLite, it can't be dropped
+        db.metadata.reflect(db.engine, only=lambda name, meta: not name.startswith("sqlite_"))
         db.drop_all()
         db.create_all()
 
@@ -1857,4 +1861,1141 @@ def test_put_portion_415_bad_request(app):
             method='put')
         assert r.status_code == 415
         assert_content_type(r)
-        assert_control_profile_error(r)
\ No newline at end of file
+        assert_control_profile_error(r)
+
+def test_meal_collection_pagination(app):
+    with app.app_context():
+        for i in range(5):
+            add_meal_to_db("meal-{}".format(i))
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "?limit=2", method="GET")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [m['id'] for m in body['items']] == ["meal-0", "meal-1"]
+        assert 'prev' not in body['@controls']
+
+        # follow next controls until the last page
+        r = client.get(body['@controls']['next']['href'])
+        body = json.loads(r.data)
+        assert [m['id'] for m in body['items']] == ["meal-2", "meal-3"]
+        r = client.get(body['@controls']['next']['href'])
+        body = json.loads(r.data)
+        assert [m['id'] for m in body['items']] == ["meal-4"]
+        assert 'next' not in body['@controls']
+
+        # and back with prev
+        r = client.get(body['@controls']['prev']['href'])
+        body = json.loads(r.data)
+        assert [m['id'] for m in body['items']] == ["meal-2", "meal-3"]
+        assert 'prev' in body['@controls']
+
+
+def test_mealrecords_for_person_pagination(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        add_person_to_db("456")
+        meal_id = 'oatmeal'
+        add_meal_to_db(meal_id)
+        for day in range(1, 4):
+            add_mealrecord_to_db(person_id, meal_id, datetime.datetime(2021, 4, day, 12, 0, 0))
+        add_mealrecord_to_db("456", meal_id, datetime.datetime(2021, 4, 2, 12, 0, 0))
+
+        client = app.test_client()
+        href = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/mealrecords/'
+        r = client.get(href + "?limit=2", method="GET")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [m['timestamp'][:10] for m in body['items']] == ["2021-04-01", "2021-04-02"]
+        assert body['@controls']['next']['href'].startswith(href)
+
+        r = client.get(body['@controls']['next']['href'])
+        body = json.loads(r.data)
+        assert [m['timestamp'][:10] for m in body['items']] == ["2021-04-03"]
+        assert [m['person_id'] for m in body['items']] == [person_id]
+        assert 'next' not in body['@controls']
+
+
+def test_collection_pagination_400(app):
+    with app.app_context():
+        client = app.test_client()
+        for query in ["?limit=0", "?limit=abc", "?after=not-a-cursor"]:
+            r = client.get(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + query, method="GET")
+            assert r.status_code == 400
+            assert_content_type(r)
+            assert_control_profile_error(r)
+
+        # well-formed cursors of values that don't match the types of the key columns
+        def cursor(values):
+            return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+        for route, values in [(ROUTE_MEALRECORD_COLLECTION, [1, 2, 3]),
+                              (ROUTE_MEALRECORD_COLLECTION, [{}, "2021-03-01 08:00:00.000000", []]),
+                              (ROUTE_MEALRECORD_COLLECTION, [True, "2021-03-01 08:00:00.000000", 1]),
+                              (ROUTE_MEALRECORD_COLLECTION, [1, "yesterday", 1]),
+                              (ROUTE_PORTION_COLLECTION, [1])]:
+            for arg in ("after", "before"):
+                r = client.get(ROUTE_ENTRYPOINT + route + "?" + arg + "=" + cursor(values))
+                assert r.status_code == 400
+                assert_control_profile_error(r)
+
+
+def test_get_nutrition_200(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        meal_id = 'oatmeal'
+        add_meal_to_db(meal_id)
+        add_portion_to_db("oat")
+        mp = MealPortion(meal_id=meal_id, portion_id="oat", weight_per_serving=50)
+        db.session.add(mp)
+        db.session.commit()
+        add_mealrecord_to_db(person_id, meal_id, datetime.datetime(2021, 4, 20, 8, 0, 0))
+        add_mealrecord_to_db(person_id, meal_id, datetime.datetime(2021, 4, 21, 8, 0, 0))
+        add_mealrecord_to_db(person_id, meal_id, datetime.datetime(2021, 4, 21, 18, 0, 0))
+
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/', method="GET")
+        assert_control(r, NS + ":nutrition", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/')
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/', method="GET")
+        assert r.status_code == 200
+        assert_content_type(r)
+        assert_namespace(r)
+        body = json.loads(r.data)
+        # 4 servings * 50g * 120kcal/100g for each record
+        assert [i['bucket'] for i in body['items']] == ["2021-04-20", "2021-04-21"]
+        assert body['items'][0]['calories'] == pytest.approx(240)
+        assert body['items'][1]['calories'] == pytest.approx(480)
+        assert body['items'][1]['carbohydrate'] == pytest.approx(96)
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id +
+                       '/nutrition/?from=2021-04-21&bucket=month', method="GET")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [i['bucket'] for i in body['items']] == ["2021-04"]
+        assert body['items'][0]['calories'] == pytest.approx(480)
+
+
+def test_nutrition_last_microsecond_of_day(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        add_meal_to_db("oatmeal")
+        add_portion_to_db("oat")
+        db.session.add(MealPortion(meal_id="oatmeal", portion_id="oat", weight_per_serving=50))
+        db.session.commit()
+        add_mealrecord_to_db(person_id, "oatmeal", datetime.datetime(2021, 3, 2, 8, 0, 0))
+
+        client = app.test_client()
+        r = client.post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+                        data=json.dumps({"person_id": person_id, "meal_id": "oatmeal", "amount": 1,
+                                         "timestamp": "2021-03-01 23:59:59.999999"}),
+                        content_type=APPLICATION_JSON)
+        assert r.status_code == 201
+        rollups = NutritionRollup.query.order_by(NutritionRollup.day).all()
+        assert [(r.day, r.calories) for r in rollups] == [
+            (datetime.date(2021, 3, 1), pytest.approx(60)), (datetime.date(2021, 3, 2), pytest.approx(240))]
+
+        # the rollup and the meal records give the same buckets
+        for query in ('', '?from=2021-03-01 00:00:00.000001'):
+            r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/' + query)
+            body = json.loads(r.data)
+            assert [(i['bucket'], i['calories']) for i in body['items']] == [
+                ("2021-03-01", pytest.approx(60)), ("2021-03-02", pytest.approx(240))]
+
+
+def test_get_nutrition_400_404(app):
+    with app.app_context():
+        add_person_to_db("123")
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + '123/nutrition/?bucket=hour', method="GET")
+        assert r.status_code == 400
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + '123/nutrition/?from=yesterday', method="GET")
+        assert r.status_code == 400
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + '456/nutrition/', method="GET")
+        assert r.status_code == 404
+        assert_control_profile_error(r)
+
+
+def test_nutrition_follows_portion_put(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        meal_id = 'oatmeal'
+        add_meal_to_db(meal_id)
+        add_portion_to_db("oat")
+        db.session.add(MealPortion(meal_id=meal_id, portion_id="oat", weight_per_serving=50))
+        db.session.commit()
+        add_mealrecord_to_db(person_id, meal_id, datetime.datetime(2021, 4, 21, 8, 0, 0))
+
+        client = app.test_client()
+        r = client.put(
+            ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "oat/",
+            data=json.dumps({'id': 'oat', 'name': 'oat', 'calories': 200}),
+            content_type=APPLICATION_JSON,
+            method='PUT')
+        assert r.status_code == 204
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/', method="GET")
+        body = json.loads(r.data)
+        assert body['items'][0]['calories'] == pytest.approx(400)
+
+
+def test_get_meal_collection_304(app):
+    with app.app_context():
+        meal_id = "oatmeal"
+        add_meal_to_db(meal_id)
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION, method="GET")
+        assert r.status_code == 200
+        etag = r.headers['ETag']
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION, headers={'If-None-Match': etag})
+        assert r.status_code == 304
+        assert r.headers['ETag'] == etag
+        assert r.data == b""
+
+        # other tables do not change the version of the meals
+        add_portion_to_db("oat")
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION, headers={'If-None-Match': etag})
+        assert r.status_code == 304
+
+        # edit of the meal changes the etag of both, the collection and the item
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + meal_id + '/')
+        item_etag = r.headers['ETag']
+        assert item_etag != etag
+        r = client.put(
+            ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + meal_id + '/',
+            data=json.dumps({'id': meal_id, 'name': 'Porridge', 'servings': 2}),
+            content_type=APPLICATION_JSON,
+            method='PUT')
+        assert r.status_code == 204
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION, headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + meal_id + '/',
+                       headers={'If-None-Match': item_etag})
+        assert r.status_code == 200
+        assert json.loads(r.data)['name'] == 'Porridge'
+
+
+def test_get_nutrition_304(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        add_meal_to_db("oatmeal")
+        client = app.test_client()
+        href = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/'
+        r = client.get(href)
+        etag = r.headers['ETag']
+        r = client.get(href, headers={'If-None-Match': etag})
+        assert r.status_code == 304
+
+        add_mealrecord_to_db(person_id, "oatmeal", datetime.datetime(2021, 4, 21, 8, 0, 0))
+        r = client.get(href, headers={'If-None-Match': etag})
+        assert r.status_code == 200
+
+
+def test_post_with_fast_validation(app):
+    pytest.importorskip("fastjsonschema")
+    app.config["FAST_VALIDATION"] = True
+    with app.app_context():
+        client = app.test_client()
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION,
+            data=json.dumps({'id': 'Not Valid', 'name': 'Oatmeal', 'servings': 2}),
+            content_type=APPLICATION_JSON,
+            method='POST')
+        assert r.status_code == 400
+        assert_control_profile_error(r)
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION,
+            data=json.dumps({'id': 'oatmeal', 'name': 'Oatmeal', 'servings': 2.0}),
+            content_type=APPLICATION_JSON,
+            method='POST')
+        assert r.status_code == 201
+        # date-time format is not asserted, the same as without fast validation
+        add_person_to_db("123")
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+            data=json.dumps({'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1,
+                             'timestamp': '2021-04-21 10:00:0.0'}),
+            content_type=APPLICATION_JSON,
+            method='POST')
+        assert r.status_code == 201
+
+
+def test_meal_collection_schema_urls(app):
+    app.config["SCHEMA_URLS"] = True
+    with app.app_context():
+        add_meal_to_db("oatmeal")
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION, method="GET")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        schema_url = ROUTE_ENTRYPOINT + ROUTE_SCHEMA_COLLECTION + "meal/"
+        assert body['@controls'][NS + ":add-meal"]['schemaUrl'] == schema_url
+        assert 'schema' not in body['@controls'][NS + ":add-meal"]
+        assert body['items'][0]['@controls'][NS + ":edit-meal"]['schemaUrl'] == schema_url
+        assert 'schema' not in body['items'][0]['@controls'][NS + ":edit-meal"]
+
+        r = client.get(schema_url, method="GET")
+        assert r.status_code == 200
+        assert r.headers['Content-Type'] == JSON_SCHEMA
+        schema = json.loads(r.data)
+        assert schema['required'] == ["id", "name", "servings"]
+        r = client.get(schema_url, headers={'If-None-Match': r.headers['ETag']})
+        assert r.status_code == 304
+
+
+def test_get_schema_404(app):
+    with app.app_context():
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_SCHEMA_COLLECTION + "nothing/", method="GET")
+        assert r.status_code == 404
+        assert_control_profile_error(r)
+
+
+def test_post_mealrecords_bulk(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        meal_id = 'oatmeal'
+        add_meal_to_db(meal_id)
+        add_mealrecord_to_db(person_id, meal_id, datetime.datetime(2021, 4, 21, 8, 0, 0))
+        items = [
+            {'person_id': person_id, 'meal_id': meal_id, 'amount': 1, 'timestamp': '2021-04-21 12:00:00.000000'},
+            {'person_id': person_id, 'meal_id': meal_id, 'amount': 1, 'timestamp': '2021-04-21 08:00:00.000000'},
+            {'person_id': person_id, 'meal_id': meal_id, 'amount': 'one', 'timestamp': '2021-04-21 13:00:00.0'},
+            {'person_id': person_id, 'meal_id': meal_id, 'amount': 2, 'timestamp': '2021-04-21 12:00:00.000000'},
+            {'person_id': person_id, 'meal_id': 'unknown', 'amount': 2, 'timestamp': '2021-04-21 14:00:00.0'},
+            {'person_id': person_id, 'meal_id': meal_id, 'amount': 2, 'timestamp': '2021-04-22 19:00:00.0'},
+        ]
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION, method="GET")
+        assert_control(r, NS + ":add-mealrecords", ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK)
+
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK,
+            data=json.dumps(items),
+            content_type=APPLICATION_JSON,
+            method="POST")
+        assert r.status_code == 200
+        assert_content_type(r)
+        body = json.loads(r.data)
+        assert [i['status'] for i in body['items']] == \
+            ['created', 'conflict', 'invalid', 'conflict', 'conflict', 'created']
+        assert (body['created'], body['conflict'], body['invalid']) == (2, 3, 1)
+        r = client.get(body['items'][0]['@controls']['self']['href'])
+        assert r.status_code == 200
+        assert MealRecord.query.count() == 3
+
+        # rollup follows the bulk insert too
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/')
+        assert r.status_code == 200
+
+
+def test_post_mealrecords_bulk_looks_up_exact_keys(app, monkeypatch):
+    from tapi.resources import mealrecord
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        start = datetime.datetime(2021, 4, 1, 8, 0, 0)
+        for day in range(10):
+            add_mealrecord_to_db("123", "oatmeal", start + datetime.timedelta(days=day))
+        person_key = Person.query.filter_by(id="123").one().key
+        meal_key = Meal.query.filter_by(id="oatmeal").one().key
+        # one old and one new item don't read the whole history in between
+        rows = [{'person_key': person_key, 'meal_key': meal_key, 'timestamp': start},
+                {'person_key': person_key, 'meal_key': meal_key, 'timestamp': start + datetime.timedelta(days=20)}]
+        assert mealrecord.find_existing_keys(rows) == {(person_key, start, meal_key)}
+
+        # the keys are looked up in chunks
+        monkeypatch.setattr(mealrecord, "EXISTING_KEYS_CHUNK", 2)
+        items = [{'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1,
+                  'timestamp': (start + datetime.timedelta(days=day)).strftime(TIMESTAMP_FORMAT)}
+                 for day in range(7, 12)]
+        r = app.test_client().post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK, data=json.dumps(items),
+                                   content_type=APPLICATION_JSON)
+        assert r.status_code == 200
+        assert [i['status'] for i in json.loads(r.data)['items']] == \
+            ['conflict', 'conflict', 'conflict', 'created', 'created']
+
+
+# ISO 8601 variants of the timestamps that the API doesn't accept, some as long as its own
+ISO_TIMESTAMP_VARIANTS = [
+    "2021-04-21 10:00:00.000+01",
+    "2021-04-21 10:00:00+01:00",
+    "2021-04-21T10:00:00.000000",
+    "2021-04-21 10:00:00.000000Z",
+    "2021-04-21 10:00:00.000000+00:00",
+    "20210421T100000.000000000",
+]
+
+
+def test_timestamp_iso_variants_rejected(app):
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        client = app.test_client()
+        for value in ISO_TIMESTAMP_VARIANTS:
+            for url in (ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+                        ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/nutrition/"):
+                r = client.get(url, query_string={"from": value})
+                assert r.status_code == 400, (url, value)
+
+        # one invalid item per variant, the valid item of the batch is still created
+        items = [{'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1, 'timestamp': value}
+                 for value in ISO_TIMESTAMP_VARIANTS]
+        items.append({'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1, 'timestamp': '2021-04-21 10:00:00.000000'})
+        r = client.post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK, data=json.dumps(items),
+                        content_type=APPLICATION_JSON)
+        assert r.status_code == 200
+        assert [i['status'] for i in json.loads(r.data)['items']] == \
+            ['invalid'] * len(ISO_TIMESTAMP_VARIANTS) + ['created']
+
+
+def test_post_mealrecords_bulk_ndjson(app):
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        lines = [
+            json.dumps({'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1, 'timestamp': '2021-04-21 12:00:00.0'}),
+            "{not json",
+            "",
+            json.dumps({'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1, 'timestamp': '2021-04-21 13:00:00.0'}),
+        ]
+        client = app.test_client()
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK,
+            data="\n".join(lines),
+            content_type=NDJSON,
+            method="POST")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [i['status'] for i in body['items']] == ['created', 'invalid', 'created']
+
+
+def test_post_mealrecords_bulk_concurrent_conflict(app, monkeypatch):
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 21, 8, 0, 0))
+        # pretend another request created the record after the conflicts were checked
+        from tapi.resources import mealrecord
+        monkeypatch.setattr(mealrecord, "find_existing_keys", lambda rows: set())
+        items = [
+            {'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1, 'timestamp': '2021-04-21 08:00:00.000000'},
+            {'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1, 'timestamp': '2021-04-21 09:00:00.000000'},
+        ]
+        client = app.test_client()
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK,
+            data=json.dumps(items),
+            content_type=APPLICATION_JSON,
+            method="POST")
+        body = json.loads(r.data)
+        assert [i['status'] for i in body['items']] == ['conflict', 'created']
+        assert MealRecord.query.count() == 2
+
+
+def test_post_mealrecords_bulk_415_413(app):
+    app.config["MAX_BULK_ITEMS"] = 1
+    with app.app_context():
+        client = app.test_client()
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK,
+            data=json.dumps({'person_id': '123'}),
+            content_type=APPLICATION_JSON,
+            method="POST")
+        assert r.status_code == 415
+        r = client.post(
+            ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BULK,
+            data=json.dumps([{}, {}]),
+            content_type=APPLICATION_JSON,
+            method="POST")
+        assert r.status_code == 413
+        assert_control_profile_error(r)
+
+
+def test_streamed_collections_equal_buffered(app):
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        for day in range(1, 6):
+            add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, day, 12, 0, 0, 1))
+        client = app.test_client()
+        for route in [ROUTE_MEAL_COLLECTION, ROUTE_MEALRECORD_COLLECTION + "?limit=2",
+                      ROUTE_PERSON_COLLECTION + "123/mealrecords/?limit=3"]:
+            app.config["STREAM_COLLECTIONS"] = False
+            buffered = client.get(ROUTE_ENTRYPOINT + route)
+            app.config["STREAM_COLLECTIONS"] = True
+            streamed = client.get(ROUTE_ENTRYPOINT + route)
+            assert streamed.status_code == 200
+            assert_content_type(streamed)
+            assert json.loads(streamed.data) == json.loads(buffered.data)
+            assert streamed.headers['ETag'] == buffered.headers['ETag']
+
+
+@contextmanager
+def captured_statements(with_parameters=False):
+    # yields the list of the SQL statements run in the block,
+    # (statement, parameters) pairs if with_parameters is set
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters) if with_parameters else statement)
+
+    event.listen(db.engine, "before_cursor_execute", collect)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", collect)
+
+
+def query_plans(app, url):
+    # EXPLAIN QUERY PLAN details of every SELECT that a GET of the url runs
+    with captured_statements(with_parameters=True) as statements:
+        r = app.test_client().get(url)
+    assert r.status_code == 200
+    plans = []
+    with db.engine.connect() as connection:
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            rows = connection.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+            plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+
+def test_mealrecord_queries_use_indexes(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        meal_id = "oatmeal"
+        add_meal_to_db(meal_id)
+        add_portion_to_db("oat")
+        db.session.add(MealPortion(meal_id=meal_id, portion_id="oat", weight_per_serving=50))
+        db.session.commit()
+        timestamp = datetime.datetime(2021, 4, 21, 8, 0, 0, 1)
+        for day in range(1, 4):
+            add_mealrecord_to_db(person_id, meal_id, timestamp + datetime.timedelta(days=day))
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?limit=1")
+        next_page = json.loads(r.data)['@controls']['next']['href']
+
+        by_time = "ix_meal_record_person_timestamp"
+        expected = [
+            (ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION, by_time),
+            (next_page, by_time + " ((person_key,timestamp,meal_key)>(?,?,?))"),
+            (ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/mealrecords/', by_time + " (person_key=?)"),
+            (ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + meal_id + '/mealrecords/' +
+             make_mealrecord_handle(person_id, meal_id, timestamp + datetime.timedelta(days=1)) + '/',
+             by_time + " (person_key=? AND timestamp=? AND meal_key=?)"),
+            (ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/?from=2021-04-22',
+             "nutrition_rollup USING INDEX sqlite_autoindex_nutrition_rollup_1 (person_key=? AND day>?)"),
+            (ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id +
+             '/nutrition/?from=2021-04-22 12:00:00.0&to=2021-04-24 12:00:00.0',
+             by_time + " (person_key=? AND timestamp>? AND timestamp<?)"),
+        ]
+        for url, index in expected:
+            plans = query_plans(app, url)
+            assert any(index in detail for _, plan in plans for detail in plan), (url, plans)
+            for statement, plan in plans:
+                for detail in plan:
+                    # SEARCH always uses an index, SCAN only if it says so
+                    assert not detail.startswith("SCAN") or "USING" in detail, (url, statement, plan)
+                    # listings come in index order, not sorted afterwards
+                    if "GROUP BY" not in statement:
+                        assert "TEMP B-TREE" not in detail, (url, statement, plan)
+
+
+def test_request_instrumentation(app):
+    from tapi.instrumentation import route_metrics
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 1, 12, 0, 0, 1))
+        client = app.test_client()
+        resp = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION)
+        assert 'Server-Timing' not in resp.headers
+        assert route_metrics(app).snapshot() == {}
+
+        app.config["INSTRUMENTATION"] = True
+        resp = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION)
+        assert resp.headers['Server-Timing'].startswith('app;dur=')
+        assert 'queries"' in resp.headers['Server-Timing']
+        client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION)
+        app.config["STREAM_COLLECTIONS"] = True
+        streamed = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION)
+        # a streamed response is recorded once its body has been sent
+        assert len(streamed.data) > 0
+
+        metrics = route_metrics(app).snapshot()
+        meals = metrics['GET ' + ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION]
+        assert meals['wall_time']['count'] == 2
+        assert sum(meals['sql_count']['counts']) == 2
+        # at least the ETag version lookup and the page query
+        assert meals['sql_count']['sum'] >= 4
+        assert meals['response_bytes']['sum'] == 2 * len(resp.data)
+        records = metrics['GET ' + ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION]
+        assert records['response_bytes']['sum'] == len(streamed.data)
+        assert records['sql_count']['sum'] >= 2
+
+
+def test_prometheus_metrics(app, tmp_path):
+    from tapi.instrumentation import route_metrics
+    with app.app_context():
+        add_person_to_db("123")
+        client = app.test_client()
+        assert client.get(ROUTE_METRICS).status_code == 404
+
+        app.config["INSTRUMENTATION"] = True
+        client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/")
+        client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "124/")
+        client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/mealrecords/")
+        resp = client.get(ROUTE_METRICS)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        text = resp.data.decode()
+        labels = 'resource="PersonItem",method="GET",route="/api/persons/<handle>/"'
+        assert 'tapi_requests_total{' + labels + ',status="200"} 1' in text
+        assert 'tapi_requests_total{' + labels + ',status="404"} 1' in text
+        assert 'tapi_requests_in_flight{' + labels + '} 0' in text
+        assert 'tapi_request_duration_seconds_bucket{' + labels + ',le="+Inf"} 2' in text
+        assert 'tapi_db_pool_wait_seconds_count{' + labels + '} 2' in text
+        assert 'tapi_response_size_bytes_count{' + labels + '} 2' in text
+        assert 'resource="MealRecordItem",method="GET",route="/api/persons/<handle>/mealrecords/"' in text
+
+        # another worker that has exited left its aggregates into the directory
+        app.config["METRICS_DIR"] = str(tmp_path)
+        worker = route_metrics(app).to_dict()
+        worker[next(iter(worker))]['in_flight'] = 5
+        (tmp_path / "999999999-1.json").write_text(json.dumps(worker))
+        text = client.get(ROUTE_METRICS).data.decode()
+        assert 'tapi_requests_total{' + labels + ',status="200"} 2' in text
+        assert 'tapi_request_duration_seconds_count{' + labels + '} 4' in text
+        assert 'tapi_requests_in_flight{' + labels + '} 0' in text
+        assert len(list(tmp_path.glob("*.json"))) == 2
+
+
+def test_json_encoders_equal(app):
+    from tapi.utils import JSON_ENCODERS
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        for second in (0, 1):
+            add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 1, 12, 0, second, second))
+        client = app.test_client()
+        routes = [ROUTE_MEAL_COLLECTION, ROUTE_MEALRECORD_COLLECTION, ROUTE_PERSON_COLLECTION + "123/nutrition/"]
+        app.config["JSON_ENCODER"] = "json"
+        expected = [client.get(ROUTE_ENTRYPOINT + route).data for route in routes]
+        # the timestamps keep their format whatever the encoder
+        assert json.loads(expected[1])["items"][0]["timestamp"] == "2021-04-01 12:00:00"
+        for name in JSON_ENCODERS:
+            app.config["JSON_ENCODER"] = name
+            for route, data in zip(routes, expected):
+                resp = client.get(ROUTE_ENTRYPOINT + route)
+                assert resp.status_code == 200
+                assert json.loads(resp.data) == json.loads(data)
+
+
+def test_collection_item_controls_equal_item_controls(app):
+    from urllib.parse import unquote
+    with app.app_context():
+        add_meal_to_db("oatmeal")
+        add_meal_to_db("oat,meal")
+        add_portion_to_db("oat")
+        client = app.test_client()
+        for route in [ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION]:
+            body = json.loads(client.get(ROUTE_ENTRYPOINT + route).data)
+            assert len(body["items"]) >= 1
+            for item in body["items"]:
+                item_controls = json.loads(client.get(ROUTE_ENTRYPOINT + route + item["id"] + "/").data)["@controls"]
+                for name, ctrl in item["@controls"].items():
+                    expected = item_controls[name]
+                    assert unquote(ctrl.pop("href")) == unquote(expected.pop("href"))
+                    assert ctrl == expected
+
+
+def test_collection_compact_views(app):
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        for day in range(1, 4):
+            add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, day, 12, 0, 0, 1))
+        client = app.test_client()
+        for stream in (False, True):
+            app.config["STREAM_COLLECTIONS"] = stream
+            for route in [ROUTE_MEAL_COLLECTION, ROUTE_PORTION_COLLECTION, ROUTE_MEALRECORD_COLLECTION,
+                          ROUTE_PERSON_COLLECTION + "123/mealrecords/"]:
+                mason = client.get(ROUTE_ENTRYPOINT + route)
+                assert mason.headers["Content-Type"] == MASON
+                assert mason.headers["Vary"] == "Accept, Accept-Encoding"
+                expected = [{k: v for k, v in item.items() if k != "@controls"}
+                            for item in json.loads(mason.data)["items"]]
+
+                compact = client.get(ROUTE_ENTRYPOINT + route + "?view=compact")
+                assert compact.headers["Content-Type"] == COMPACT_JSON
+                assert json.loads(compact.data) == {"items": expected}
+                negotiated = client.get(ROUTE_ENTRYPOINT + route, headers={"Accept": COMPACT_JSON})
+                assert negotiated.headers["Content-Type"] == COMPACT_JSON
+                assert negotiated.data == compact.data
+                assert negotiated.headers["ETag"] != mason.headers["ETag"]
+
+                columns = json.loads(client.get(ROUTE_ENTRYPOINT + route, headers={"Accept": COLUMNS_JSON}).data)
+                assert [dict(zip(columns["columns"], row)) for row in columns["rows"]] == expected
+
+        # the pages of a view link to the pages of the same view
+        resp = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?view=columns&limit=2")
+        body = json.loads(resp.data)
+        assert len(body["rows"]) == 2 and "prev" not in body
+        resp = client.get(body["next"])
+        body = json.loads(resp.data)
+        assert len(body["rows"]) == 1 and "next" not in body
+        assert "view=columns" in body["prev"]
+
+        assert client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "?view=xml").status_code == 400
+
+
+def test_msgpack_negotiation(app):
+    msgpack = pytest.importorskip("msgpack")
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        client = app.test_client()
+        record = {"person_id": "123", "meal_id": "oatmeal", "amount": 1.5,
+                  "timestamp": "2021-04-01 12:00:00.000001"}
+        r = client.post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+                        data=msgpack.packb(record), content_type=MSGPACK)
+        assert r.status_code == 201
+        r = client.post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+                        data=b"\xc1", content_type=MSGPACK)
+        assert r.status_code == 415
+        r = client.post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+                        data=msgpack.packb(dict(record, amount="many")), content_type=MSGPACK)
+        assert r.status_code == 400
+        assert r.headers["Content-Type"] == MASON
+
+        for stream in (False, True):
+            app.config["STREAM_COLLECTIONS"] = stream
+            for url in [ROUTE_MEALRECORD_COLLECTION, ROUTE_MEALRECORD_COLLECTION + "?view=columns",
+                        ROUTE_MEAL_COLLECTION + "oatmeal/", ROUTE_PERSON_COLLECTION + "123/nutrition/"]:
+                expected = json.loads(client.get(ROUTE_ENTRYPOINT + url).data)
+                r = client.get(ROUTE_ENTRYPOINT + url, headers={"Accept": MSGPACK})
+                assert r.status_code == 200
+                assert r.headers["Content-Type"] == MSGPACK
+                assert msgpack.unpackb(r.data) == expected
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "nothing/", headers={"Accept": MSGPACK})
+        assert r.status_code == 404
+        assert "@error" in msgpack.unpackb(r.data)
+
+
+def test_compressed_responses(app):
+    import gzip
+    with app.app_context():
+        for i in range(20):
+            add_portion_to_db("portion-{}".format(i))
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION
+        plain = client.get(url)
+        assert "Content-Encoding" not in plain.headers
+
+        compressed = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert compressed.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(compressed.data) == plain.data
+        assert len(compressed.data) < len(plain.data)
+        assert compressed.headers["ETag"] == 'W/' + plain.headers["ETag"]
+        r = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": compressed.headers["ETag"]})
+        assert r.status_code == 304
+
+        # the unchanged collection is served from the cache of compressed bodies, without querying it
+        with captured_statements() as statements:
+            cached = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert cached.data == compressed.data
+        assert not any("FROM portion" in statement for statement in statements)
+
+        add_portion_to_db("portion-new")
+        changed = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert changed.headers["ETag"] != compressed.headers["ETag"]
+        assert b"portion-new" in gzip.decompress(changed.data)
+
+        # small responses and clients that don't accept any of the encodings get the identity
+        app.config["COMPRESS_MIN_SIZE"] = 10 ** 6
+        small = client.get(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "portion-1/",
+                           headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in small.headers
+        r = client.get(url, headers={"Accept-Encoding": "compress"})
+        assert r.data == client.get(url).data
+        app.config["COMPRESSION"] = False
+        assert "Content-Encoding" not in client.get(url, headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_expand_related_resources(app):
+    def count_selects(client, url):
+        with captured_statements() as statements:
+            resp = client.get(url)
+        assert resp.status_code == 200
+        return json.loads(resp.data), sum(1 for s in statements if s.lstrip().startswith("SELECT"))
+
+    with app.app_context():
+        add_person_to_db("person-1")
+        add_meal_to_db("meal-1")
+        add_meal_to_db("meal-2")
+        for i in range(6):
+            add_portion_to_db("portion-{}".format(i))
+            db.session.add(MealPortion(meal_id="meal-1" if i < 2 else "meal-2",
+                                       portion_id="portion-{}".format(i), weight_per_serving=10 + i))
+        db.session.commit()
+        for i in range(3):
+            add_mealrecord_to_db("person-1", "meal-1" if i == 0 else "meal-2",
+                                 datetime.datetime(2021, 3, 1, 8 + i, 0, 0, 1))
+        client = app.test_client()
+
+        # the meal with 2 portions takes as many queries as the meal with 4
+        url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "{}/?expand=portions.portion"
+        meal1, count1 = count_selects(client, url.format("meal-1"))
+        meal2, count2 = count_selects(client, url.format("meal-2"))
+        assert count1 == count2
+        assert [mp["portion_id"] for mp in meal2["portions"]] == ["portion-2", "portion-3", "portion-4", "portion-5"]
+        mealportion = meal1["portions"][0]
+        assert mealportion["weight_per_serving"] == 10
+        assert mealportion["@controls"]["self"]["href"] == ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + \
+            "meal-1/mealportions/" + make_mealportion_handle("meal-1", "portion-0") + "/"
+        portion = mealportion["portion"]
+        expected = json.loads(client.get(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "portion-0/").data)
+        assert portion["@controls"]["self"] == expected["@controls"]["self"]
+        assert {k: v for k, v in portion.items() if not k.startswith("@")} == \
+            {k: v for k, v in expected.items() if not k.startswith("@")}
+        assert "portion" not in json.loads(client.get(url.format("meal-1").replace(".portion", "")).data)["portions"][0]
+        assert "portions" not in json.loads(client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/").data)
+
+        # collections too, the expansion is kept in the page links
+        url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "?expand=portions&limit=1"
+        body, _ = count_selects(client, url)
+        assert body["items"][0]["portions"][0]["portion_id"] == "portion-0"
+        assert "expand=portions" in body["@controls"]["next"]["href"]
+
+        url = ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?expand=meal.portions.portion"
+        body, count = count_selects(client, url)
+        _, count_one = count_selects(client, url + "&limit=1")
+        assert count == count_one
+        assert [len(m["meal"]["portions"]) for m in body["items"]] == [2, 4, 4]
+        assert body["items"][0]["meal"]["@controls"]["self"]["href"] == \
+            ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/"
+        assert body["items"][1]["meal"]["portions"][0]["portion"]["name"] == "oat"
+
+        # changing an embedded resource changes the ETag of the expanded representation only
+        url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/"
+        etag = client.get(url).headers["ETag"]
+        expanded_etag = client.get(url + "?expand=portions.portion").headers["ETag"]
+        Portion.query.filter_by(id="portion-0").first().name = "rolled oat"
+        db.session.commit()
+        assert client.get(url).headers["ETag"] == etag
+        r = client.get(url + "?expand=portions.portion", headers={"If-None-Match": expanded_etag})
+        assert r.status_code == 200
+        assert json.loads(r.data)["portions"][0]["portion"]["name"] == "rolled oat"
+
+        assert client.get(url + "?expand=mealrecords").status_code == 400
+        assert client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?expand=portions").status_code == 400
+
+
+def test_mealportion_collection(app):
+    with app.app_context():
+        add_meal_to_db("meal-1")
+        add_meal_to_db("meal-2")
+        add_portion_to_db("oat")
+        add_portion_to_db("milk")
+        Portion.query.filter_by(id="milk").first().fat = None
+        db.session.add(MealPortion(meal_id="meal-1", portion_id="oat", weight_per_serving=50))
+        db.session.add(MealPortion(meal_id="meal-1", portion_id="milk", weight_per_serving=200))
+        db.session.commit()
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/mealportions/"
+
+        with captured_statements() as statements:
+            resp = client.get(url)
+        assert resp.status_code == 200
+        assert_content_type(resp)
+        assert sum(1 for s in statements if "FROM meal_portion" in s) == 1
+        assert_self_url(resp, url)
+        assert_namespace(resp)
+        body = json.loads(resp.data)
+        assert body["@controls"]["up"]["href"] == ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/"
+        assert body["@controls"][NS + ":add-mealportion"]["method"] == "POST"
+        assert [item["portion_id"] for item in body["items"]] == ["milk", "oat"]
+        milk, oat = body["items"]
+        assert milk["portion"]["name"] == "oat"
+        assert oat["nutrients_per_serving"]["calories"] == 60
+        assert milk["nutrients_per_serving"]["fat"] == 0
+        assert body["nutrients_per_serving"]["calories"] == 300
+        assert body["nutrients_per_serving"]["protein"] == 25
+        assert body["nutrients"]["calories"] == 300 * 4
+        assert body["servings"] == 4
+
+        # the collection advertised by the items and the meal
+        item_url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/mealportions/" + \
+            make_mealportion_handle("meal-1", "oat") + "/"
+        item = json.loads(client.get(item_url).data)
+        assert item["@controls"]["collection"]["href"] == url
+        meal = json.loads(client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/").data)
+        assert meal["@controls"][NS + ":mealportions"]["href"] == url
+
+        empty = json.loads(client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-2/mealportions/").data)
+        assert empty["items"] == []
+        assert empty["nutrients"]["calories"] == 0
+        assert client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "nothing/mealportions/").status_code == 404
+
+        etag = resp.headers["ETag"]
+        Portion.query.filter_by(id="oat").first().calories = 100
+        db.session.commit()
+        r = client.get(url, headers={"If-None-Match": etag})
+        assert r.status_code == 200
+        assert json.loads(r.data)["nutrients_per_serving"]["calories"] == 290
+
+
+def delete_portion_without_fks(portion_id):
+    # like PortionItem.delete in production, where the foreign keys are not enforced
+    # and the MealPortions of the Portion are left behind
+    with db.engine.connect() as connection:
+        connection.execute("PRAGMA foreign_keys=OFF")
+        connection.execute(Portion.__table__.delete().where(Portion.id == portion_id))
+        bump_versions(connection, [Portion.__tablename__])
+
+
+@pytest.mark.parametrize("catalogue_rows", [CATALOGUE_CACHE_ROWS, 0])
+def test_mealportions_of_deleted_portion(app, catalogue_rows):
+    app.config["CATALOGUE_CACHE_ROWS"] = catalogue_rows
+    with app.app_context():
+        add_meal_to_db("meal-1")
+        add_portion_to_db("oat")
+        add_portion_to_db("milk")
+        db.session.add(MealPortion(meal_id="meal-1", portion_id="oat", weight_per_serving=50))
+        db.session.add(MealPortion(meal_id="meal-1", portion_id="milk", weight_per_serving=200))
+        db.session.commit()
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/mealportions/"
+        assert len(json.loads(client.get(url).data)["items"]) == 2
+        delete_portion_without_fks("milk")
+
+        r = client.get(url)
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [i["portion_id"] for i in body["items"]] == ["oat"]
+        assert body["nutrients_per_serving"]["calories"] == pytest.approx(60)
+
+        # and from the embedded MealPortions
+        for expand in ("portions", "portions.portion"):
+            r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/?expand=" + expand)
+            assert r.status_code == 200
+            assert [p["portion_id"] for p in json.loads(r.data)["portions"]] == ["oat"]
+        add_person_to_db("person-1")
+        add_mealrecord_to_db("person-1", "meal-1", datetime.datetime(2021, 3, 1, 8))
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?expand=meal.portions.portion")
+        assert r.status_code == 200
+        assert [p["portion"]["id"] for p in json.loads(r.data)["items"][0]["meal"]["portions"]] == ["oat"]
+
+
+def test_mealportion_item_etag_follows_portion(app):
+    with app.app_context():
+        add_meal_to_db("meal-1")
+        add_portion_to_db("oat")
+        add_portion_to_db("milk")
+        db.session.add(MealPortion(meal_id="meal-1", portion_id="oat", weight_per_serving=50))
+        db.session.add(MealPortion(meal_id="meal-1", portion_id="milk", weight_per_serving=200))
+        db.session.commit()
+        client = app.test_client()
+        urls = [ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/mealportions/" +
+                make_mealportion_handle("meal-1", portion) + "/" for portion in ("oat", "milk")]
+        etags = [client.get(url).headers["ETag"] for url in urls]
+        assert [client.get(url, headers={"If-None-Match": etag}).status_code
+                for url, etag in zip(urls, etags)] == [304, 304]
+
+        # a change of the Portion table changes the ETags
+        Portion.query.filter_by(id="oat").one().calories = 100
+        db.session.commit()
+        assert client.get(urls[0], headers={"If-None-Match": etags[0]}).status_code == 200
+        delete_portion_without_fks("milk")
+        assert client.get(urls[1], headers={"If-None-Match": etags[1]}).status_code == 404
+
+
+def test_mealrecord_filters(app):
+    with app.app_context():
+        add_person_to_db("person-1")
+        add_person_to_db("person-2")
+        add_meal_to_db("meal-1")
+        add_meal_to_db("meal-2")
+        for day in range(1, 11):
+            add_mealrecord_to_db("person-1", "meal-1" if day % 2 else "meal-2", datetime.datetime(2021, 3, day, 8, 0, 0, 1))
+            add_mealrecord_to_db("person-2", "meal-1", datetime.datetime(2021, 3, day, 9, 0, 0, 1))
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "person-1/mealrecords/"
+
+        def timestamps(url):
+            resp = client.get(url)
+            assert resp.status_code == 200
+            return [item["timestamp"][:10] for item in json.loads(resp.data)["items"]]
+
+        assert timestamps(url + "?from=2021-03-08") == ["2021-03-08", "2021-03-09", "2021-03-10"]
+        assert timestamps(url + "?from=2021-03-02&to=2021-03-04") == ["2021-03-02", "2021-03-03"]
+        assert timestamps(url + "?to=2021-03-02 08:00:00.000001") == ["2021-03-01"]
+        assert timestamps(url + "?meal_id=meal-2&from=2021-03-05") == ["2021-03-06", "2021-03-08", "2021-03-10"]
+        assert timestamps(url + "?order=desc&limit=3") == ["2021-03-10", "2021-03-09", "2021-03-08"]
+
+        # the filters and the order are kept in the page links
+        body = json.loads(client.get(url + "?order=desc&limit=2&from=2021-03-05").data)
+        next_href = body["@controls"]["next"]["href"]
+        assert "from=2021-03-05" in next_href and "order=desc" in next_href
+        assert timestamps(next_href) == ["2021-03-08", "2021-03-07"]
+        prev_href = json.loads(client.get(next_href).data)["@controls"]["prev"]["href"]
+        assert timestamps(prev_href) == ["2021-03-10", "2021-03-09"]
+
+        all_url = ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION
+        items = json.loads(client.get(all_url + "?meal_id=meal-1&from=2021-03-09").data)["items"]
+        assert [(i["person_id"], i["timestamp"][:10]) for i in items] == \
+            [("person-1", "2021-03-09"), ("person-2", "2021-03-09"), ("person-2", "2021-03-10")]
+
+        for query in ("?from=yesterday", "?to=2021-13-01", "?order=random"):
+            assert client.get(url + query).status_code == 400
+
+
+def disable_foreign_keys(dbapi_connection, connection_record):
+    # runs after set_sqlite_pragma of the Engine class
+    dbapi_connection.execute("PRAGMA foreign_keys=OFF")
+
+
+def test_delete_portion_without_foreign_keys(app):
+    with app.app_context():
+        # production doesn't enforce the foreign keys
+        event.listen(db.engine, "connect", disable_foreign_keys)
+        try:
+            assert db.session.execute("PRAGMA foreign_keys").scalar() == 0
+            add_person_to_db("person-1")
+            add_meal_to_db("m1")
+            add_portion_to_db("oat")
+            db.session.add(MealPortion(meal_id="m1", portion_id="oat", weight_per_serving=50))
+            db.session.commit()
+            add_mealrecord_to_db("person-1", "m1", datetime.datetime(2021, 3, 1, 8))
+            assert NutritionRollup.query.one().calories == pytest.approx(240)
+            oat_key = Portion.query.filter_by(id="oat").one().key
+
+            client = app.test_client()
+            url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "m1/mealportions/"
+            assert len(json.loads(client.get(url).data)["items"]) == 1
+            assert client.delete(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "oat/").status_code == 204
+            assert MealPortion.query.count() == 0
+            assert NutritionRollup.query.count() == 0
+
+            # a new Portion doesn't get the key of the deleted one, nor its MealPortions
+            r = client.post(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION,
+                            data=json.dumps({"id": "lard", "name": "lard", "calories": 900}),
+                            content_type=APPLICATION_JSON)
+            assert r.status_code == 201
+            assert Portion.query.filter_by(id="lard").one().key > oat_key
+            assert json.loads(client.get(url).data)["items"] == []
+        finally:
+            event.remove(db.engine, "connect", disable_foreign_keys)
+
+
+def test_delete_cascades_set_based(app):
+    with app.app_context():
+        add_person_to_db("person-1")
+        add_person_to_db("person-2")
+        add_meal_to_db("meal-1")
+        add_meal_to_db("meal-2")
+        add_portion_to_db("oat")
+        db.session.add(MealPortion(meal_id="meal-1", portion_id="oat", weight_per_serving=100))
+        db.session.add(MealPortion(meal_id="meal-2", portion_id="oat", weight_per_serving=50))
+        db.session.commit()
+        for day in range(1, 21):
+            for person in ("person-1", "person-2"):
+                add_mealrecord_to_db(person, "meal-1", datetime.datetime(2021, 3, day, 8, 0, 0, 1))
+                if day % 2:
+                    add_mealrecord_to_db(person, "meal-2", datetime.datetime(2021, 3, day, 12, 0, 0, 1))
+        client = app.test_client()
+        records_etag = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION).headers["ETag"]
+
+        # the statements don't depend on the number of records
+        with captured_statements() as statements:
+            r = client.delete(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/")
+        assert r.status_code == 204
+        assert len(statements) < 20
+        assert Meal.query.filter_by(id="meal-1").first() is None
+        assert MealRecord.query.filter(MealRecord.meal_id == "meal-1").count() == 0
+        assert MealPortion.query.filter(MealPortion.meal_id == "meal-1").count() == 0
+        assert MealRecord.query.count() == 20
+        # the rollup is left with meal-2, 4 servings * 50g * 120kcal / 100g on the odd days
+        rollups = NutritionRollup.query.filter(NutritionRollup.person_id == "person-1") \
+            .order_by(NutritionRollup.day).all()
+        assert [r.day.day for r in rollups] == list(range(1, 21, 2))
+        assert all(r.calories == pytest.approx(240) for r in rollups)
+        assert client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+                          headers={"If-None-Match": records_etag}).status_code == 200
+        assert client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "meal-1/").status_code == 404
+
+        db.session.add(Activity(id="walk", name="Walk", intensity=2))
+        db.session.add(ActivityRecord(person_id="person-1", activity_id="walk", duration=30,
+                                      timestamp=datetime.datetime(2021, 3, 1, 10, 0)))
+        db.session.commit()
+        r = client.delete(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "person-1/")
+        assert r.status_code == 204
+        assert Person.query.filter_by(id="person-1").first() is None
+        assert MealRecord.query.filter(MealRecord.person_id == "person-1").count() == 0
+        assert ActivityRecord.query.count() == 0
+        assert NutritionRollup.query.filter(NutritionRollup.person_id == "person-1").count() == 0
+        assert NutritionRollup.query.filter(NutritionRollup.person_id == "person-2").count() == 10
+        assert client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "person-1/").status_code == 404
+
+
+def test_catalogue_cache(app):
+    from tapi.catalogue import CatalogueCache, catalogue_cache
+    with app.app_context():
+        add_portion_to_db("oat")
+        add_portion_to_db("milk")
+        add_meal_to_db("porridge")
+        db.session.add(MealPortion(meal_id="porridge", portion_id="oat", weight_per_serving=100))
+        db.session.commit()
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "oat/"
+        assert json.loads(client.get(url).data)["name"] == "oat"
+        snapshot = catalogue_cache().snapshots["portion"]
+
+        # a cached item costs the version lookups only
+        with captured_statements() as statements:
+            r = client.get(url, headers={"Accept-Encoding": "identity", "If-None-Match": "x"})
+        assert r.status_code == 200
+        assert all("table_version" in s for s in statements)
+        assert catalogue_cache().snapshots["portion"] is snapshot
+
+        # a write outside the API, e.g. in another worker, bumps the version in the DB
+        Portion.query.filter_by(id="oat").one().name = "rolled oats"
+        db.session.commit()
+        assert json.loads(client.get(url).data)["name"] == "rolled oats"
+        body = json.loads(client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "porridge/mealportions/").data)
+        assert body["items"][0]["portion"]["name"] == "rolled oats"
+        assert body["nutrients"]["calories"] == pytest.approx(4 * 120)
+
+        # the writes of the API drop the snapshot right away
+        r = client.put(url, json={"id": "oat", "name": "oats", "calories": 120})
+        assert r.status_code == 204
+        assert "portion" not in catalogue_cache().snapshots
+        assert json.loads(client.get(url).data)["name"] == "oats"
+        r = client.delete(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "porridge/")
+        assert r.status_code == 204
+        assert client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "porridge/").status_code == 404
+
+        # the least recently used catalogue is evicted, a too big one is not cached
+        add_meal_to_db("toast")
+        cache = CatalogueCache(3)
+        assert len(cache.get(Portion)) == 2
+        assert len(cache.get(Meal)) == 1
+        assert set(cache.snapshots) == {"portion", "meal"}
+        add_meal_to_db("jam")
+        assert len(cache.get(Meal)) == 2
+        assert set(cache.snapshots) == {"meal"}
+        add_meal_to_db("tea")
+        add_meal_to_db("coffee")
+        assert cache.get(Meal) is None
+        assert cache.get(Portion) is not None
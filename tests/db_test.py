@@ -4,37 +4,54 @@ import pytest
 from sqlalchemy.exc import IntegrityError
 
 from tapi import db, create_app
-from tapi.models import Person, Activity, Meal, MealRecord, ActivityRecord, Portion, MealPortion
+from tapi.models import Person, Activity, Meal, MealRecord, ActivityRecord, Portion, MealPortion, NutritionRollup
+from tapi.rollup import rebuild_rollup
 
 # BEGIN Original fixture setup taken from the Exercise example and then modified further
 
 import os
 import tempfile
 from sqlalchemy.engine import Engine
-from sqlalchemy import event, and_
+from sqlalchemy import event, and_, inspect
 
 
 @pytest.fixture
-def app():
-    db_fd, db_fname = tempfile.mkstemp()
-    config = {
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
-    }
+def make_app():
+    """ Factory of apps on new temporary DB files, make_app(**config) overrides the test config.
+    Unlike the app fixture, the DB is left as create_app leaves it. """
+    created = []
+
+    def make(**config):
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app(dict({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "TESTING": True
+        }, **config))
+        created.append((app, db_fd, db_fname))
+        return app
+
+    yield make
+    for app, db_fd, db_fname in created:
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
 
-    app = create_app(config)
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
 
     with app.app_context():
         # First empty the prepopulated db
-        db.reflect()
+        # sqlite_sequence of the AUTOINCREMENT keys belongs to SQLite, it can't be dropped
+        db.metadata.reflect(db.engine, only=lambda name, meta: not name.startswith("sqlite_"))
         db.drop_all()
         # create tables
         db.create_all()
 
     yield app
-    db.session.remove()
-    os.close(db_fd)
-    os.unlink(db_fname)
 
 
 # TODO: check if this is needed at all
@@ -882,3 +899,222 @@ def test_meal_portion_cascade_meal(app):
         assert MealPortion.query.filter(MealPortion.meal_id == mid).first() is None
 
 # TODO: test for do not permit delete for Portion if there is Meals mapped to the portion
+
+
+def add_rollup_test_data():
+    db.session.add(Person(id="123"))
+    db.session.add(Portion(id="oat", name="oat", calories=100, protein=10))
+    db.session.add(Portion(id="milk", name="milk", calories=40, fat=2))
+    db.session.add(Meal(id="oatmeal", name="Oatmeal", servings=1))
+    db.session.add(MealPortion(meal_id="oatmeal", portion_id="oat", weight_per_serving=50))
+    db.session.add(MealPortion(meal_id="oatmeal", portion_id="milk", weight_per_serving=200))
+    db.session.add(MealRecord(person_id="123", meal_id="oatmeal", amount=2,
+                              timestamp=datetime.datetime(2021, 4, 21, 8, 0)))
+    db.session.add(MealRecord(person_id="123", meal_id="oatmeal", amount=1,
+                              timestamp=datetime.datetime(2021, 4, 21, 20, 0)))
+    db.session.commit()
+
+
+def test_nutrition_rollup_follows_changes(app):
+    with app.app_context():
+        """
+        Test that the daily rollup is updated on MealRecord, MealPortion and Portion changes
+        """
+        add_rollup_test_data()
+        day = datetime.date(2021, 4, 21)
+        rollup = NutritionRollup.query.filter(NutritionRollup.person_id == "123").one()
+        assert rollup.day == day
+        # 3 servings * (50g * 100kcal + 200g * 40kcal) / 100g
+        assert rollup.calories == pytest.approx(390)
+        assert rollup.protein == pytest.approx(15)
+        assert rollup.fat == pytest.approx(12)
+
+        # Portion change fans out to every day the meal was eaten
+        portion = Portion.query.filter(Portion.id == "oat").first()
+        portion.calories = 200
+        db.session.commit()
+        assert NutritionRollup.query.one().calories == pytest.approx(540)
+
+        mp = MealPortion.query.filter(MealPortion.portion_id == "milk").first()
+        db.session.delete(mp)
+        db.session.commit()
+        assert NutritionRollup.query.one().calories == pytest.approx(300)
+
+        # moving a record to another day updates both days
+        record = MealRecord.query.filter(MealRecord.amount == 1).first()
+        record.timestamp = datetime.datetime(2021, 4, 22, 8, 0)
+        db.session.commit()
+        rollups = NutritionRollup.query.order_by(NutritionRollup.day).all()
+        assert [r.calories for r in rollups] == [pytest.approx(200), pytest.approx(100)]
+
+        # deleting the person removes the rollup rows with the records
+        db.session.delete(Person.query.first())
+        db.session.commit()
+        assert NutritionRollup.query.count() == 0
+
+
+def test_nutrition_rollup_rebuild(app):
+    with app.app_context():
+        """
+        Test that the rollup can be repaired from the raw tables
+        """
+        add_rollup_test_data()
+        expected = [(r.person_id, r.day, r.calories) for r in NutritionRollup.query.all()]
+        NutritionRollup.query.delete()
+        db.session.commit()
+        assert NutritionRollup.query.count() == 0
+
+        rebuild_rollup()
+        assert [(r.person_id, r.day, r.calories) for r in NutritionRollup.query.all()] == expected
+
+
+def test_sqlite_production_profile(make_app):
+    """
+    Test that the production profile pragmas are set on every pooled connection
+    """
+    app = make_app(SQLITE_PROFILE="production", SQLITE_PRAGMAS={"cache_size": -1024})
+    with app.app_context():
+        engine = db.get_engine(app)
+        connections = [engine.connect() for _ in range(2)]
+        for connection in connections:
+            assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+            # NORMAL
+            assert connection.execute("PRAGMA synchronous").scalar() == 1
+            assert connection.execute("PRAGMA busy_timeout").scalar() == 5000
+            assert connection.execute("PRAGMA cache_size").scalar() == -1024
+            # MEMORY
+            assert connection.execute("PRAGMA temp_store").scalar() == 2
+        for connection in connections:
+            connection.close()
+        assert engine.pool.checkedin() == 2
+
+
+def test_fast_start_and_init_db(make_app):
+    """
+    Test that FAST_START leaves the DB alone and 'flask init-db' bootstraps it
+    """
+    app = make_app(FAST_START=True)
+    with app.app_context():
+        assert db.engine.table_names() == []
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["init-db", "--no-example-data"])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert "meal_record" in db.engine.table_names()
+        indexes = {i['name'] for i in inspect(db.engine).get_indexes("meal_record")}
+        assert "ix_meal_record_person_timestamp" in indexes
+        assert Person.query.count() == 0
+
+    result = runner.invoke(args=["init-db"])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert Person.query.count() == 1
+
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE person (id VARCHAR(128) NOT NULL, PRIMARY KEY (id))",
+    "CREATE TABLE meal (id VARCHAR(128) NOT NULL, name VARCHAR(128) NOT NULL, servings FLOAT NOT NULL, "
+    "description VARCHAR(8192), PRIMARY KEY (id))",
+    "CREATE TABLE portion (id VARCHAR(128) NOT NULL, name VARCHAR(128) NOT NULL, calories FLOAT NOT NULL, "
+    "density FLOAT, alcohol FLOAT, carbohydrate FLOAT, protein FLOAT, fat FLOAT, PRIMARY KEY (id))",
+    "CREATE TABLE meal_portion (meal_id VARCHAR(128) NOT NULL, portion_id VARCHAR(128) NOT NULL, "
+    "weight_per_serving FLOAT NOT NULL, PRIMARY KEY (meal_id, portion_id))",
+    "CREATE TABLE meal_record (person_id VARCHAR(128) NOT NULL, meal_id VARCHAR(128) NOT NULL, "
+    "amount FLOAT NOT NULL, timestamp DATETIME NOT NULL, PRIMARY KEY (person_id, meal_id, timestamp))",
+    "CREATE INDEX ix_meal_record_person_timestamp ON meal_record (person_id, timestamp, meal_id, amount)",
+    "CREATE INDEX ix_meal_record_meal ON meal_record (meal_id, person_id, timestamp)",
+    "INSERT INTO person VALUES ('alice'), ('bob')",
+    "INSERT INTO meal VALUES ('soup', 'Soup', 2, NULL)",
+    "INSERT INTO portion VALUES ('carrot', 'Carrot', 41, NULL, 0, 10, 1, 0)",
+    "INSERT INTO meal_portion VALUES ('soup', 'carrot', 200)",
+    "INSERT INTO meal_record VALUES ('alice', 'soup', 1, '2021-03-01 12:00:00.000000'), "
+    "('bob', 'soup', 2, '2021-03-01 18:00:00.000000'), ('ghost', 'soup', 1, '2021-03-02 12:00:00.000000')"
+]
+
+
+def test_upgrade_to_integer_keys(make_app):
+    """
+    Test that 'flask init-db' moves a DB of the string keyed layout to the integer keys
+    """
+    app = make_app(FAST_START=True)
+    with app.app_context():
+        with db.engine.connect() as connection:
+            for statement in LEGACY_SCHEMA:
+                connection.execute(statement)
+
+    result = app.test_cli_runner().invoke(args=["init-db", "--no-example-data"])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert not [name for name in db.engine.table_names() if name.startswith("legacy_")]
+        assert "key" in {c['name'] for c in inspect(db.engine).get_columns("person")}
+        # the record of the missing person is dropped
+        records = MealRecord.query.order_by(MealRecord.timestamp).all()
+        assert [(r.person_id, r.meal_id, r.amount) for r in records] == [("alice", "soup", 1), ("bob", "soup", 2)]
+        assert records[1].timestamp == datetime.datetime(2021, 3, 1, 18)
+        assert MealPortion.query.one().portion.id == "carrot"
+        rollup = NutritionRollup.query.filter_by(person_id="bob").one()
+        assert rollup.calories == pytest.approx(2 * 200 * 41 / 100)
+
+
+def test_epoch_timestamps(app):
+    """
+    Test that the record timestamps are stored as integer microseconds and read back as datetimes,
+    and that 'flask init-db' converts the timestamps stored as text
+    """
+    with app.app_context():
+        person, meal, activity = Person(id="p"), Meal(id="m", name="M", servings=1), \
+            Activity(id="a", name="A", intensity=1)
+        timestamp = datetime.datetime(2021, 3, 1, 23, 59, 59, 999999)
+        db.session.add_all([person, meal, activity,
+                            MealRecord(person=person, meal=meal, amount=1, timestamp=timestamp),
+                            ActivityRecord(person=person, activity=activity, duration=10, timestamp=timestamp)])
+        db.session.commit()
+        assert db.session.execute("SELECT typeof(timestamp), timestamp FROM meal_record").fetchall() == \
+            [("integer", 1614643199999999)]
+        record = MealRecord.query.filter(MealRecord.timestamp > datetime.datetime(2021, 3, 1)).one()
+        assert record.timestamp == timestamp
+
+        # the text layout of DateTime
+        db.session.execute("DROP TABLE activity_record")
+        db.session.execute("CREATE TABLE activity_record (person_id VARCHAR(128) NOT NULL, "
+                           "activity_id VARCHAR(128) NOT NULL, duration INTEGER NOT NULL, timestamp DATETIME NOT NULL, "
+                           "PRIMARY KEY (person_id, activity_id, timestamp))")
+        db.session.execute("INSERT INTO activity_record VALUES ('p', 'a', 10, '2021-03-01 23:59:59.999999')")
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["init-db", "--no-example-data"])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert ActivityRecord.query.one().timestamp == timestamp
+        assert db.session.execute("SELECT typeof(timestamp) FROM activity_record").scalar() == "integer"
+
+
+def test_upgrade_autoincrement_keys(app):
+    """
+    Test that 'flask init-db' rebuilds the integer keyed tables that were created without
+    AUTOINCREMENT, keeping their keys
+    """
+    with app.app_context():
+        db.session.add_all([Portion(id="oat", name="Oat", calories=380), Portion(id="milk", name="Milk", calories=60)])
+        db.session.commit()
+        db.session.execute("DROP TABLE portion")
+        db.session.execute("CREATE TABLE portion (key INTEGER NOT NULL, id VARCHAR(128) NOT NULL, "
+                           "name VARCHAR(128) NOT NULL, calories FLOAT NOT NULL, density FLOAT, alcohol FLOAT, "
+                           "carbohydrate FLOAT, protein FLOAT, fat FLOAT, PRIMARY KEY (key), UNIQUE (id))")
+        db.session.execute("INSERT INTO portion (key, id, name, calories) VALUES (1, 'oat', 'Oat', 380), "
+                           "(2, 'milk', 'Milk', 60)")
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["init-db", "--no-example-data"])
+    assert result.exit_code == 0
+    with app.app_context():
+        sql = db.session.execute("SELECT sql FROM sqlite_master WHERE name = 'portion'").scalar()
+        assert "AUTOINCREMENT" in sql
+        assert [(p.key, p.id) for p in Portion.query.order_by(Portion.key)] == [(1, "oat"), (2, "milk")]
+        # the key of a deleted row is not given to a new one
+        db.session.delete(Portion.query.filter_by(id="milk").one())
+        db.session.commit()
+        db.session.add(Portion(id="lard", name="Lard", calories=900))
+        db.session.commit()
+        assert Portion.query.filter_by(id="lard").one().key == 3